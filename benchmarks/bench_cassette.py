@@ -0,0 +1,62 @@
+"""Бенчмарк разбора, дедупликации и сортировки на записанных ответах Kufar.
+
+Кассета пишется самим ботом (или любым сценарием с KufarAPI):
+
+    KUFAR_CASSETTE_MODE=record KUFAR_CASSETTE_PATH=prod.ndjson.gz python bot.py
+    python benchmarks/bench_cassette.py prod.ndjson.gz --runs 20
+
+Замеры идут без сети на ответах реальной формы, поэтому повторяются на любой
+машине. Сквозные сценарии можно гонять на той же кассете:
+
+    KUFAR_CASSETTE_MODE=replay KUFAR_CASSETTE_PATH=prod.ndjson.gz \\
+        python benchmarks/bench_search.py
+"""
+import argparse
+import time
+
+from common import import_bot, report
+
+bot = import_bot()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("cassette")
+    parser.add_argument("--runs", type=int, default=10)
+    args = parser.parse_args()
+
+    responses = [(record["params"].get("query"), record["body"].encode())
+                 for record in bot.KufarCassette.read_records(args.cassette)
+                 if record["status"] == 200]
+    if not responses:
+        print("В кассете нет успешных ответов")
+        return
+    size = sum(len(body) for _, body in responses)
+    print(f"Ответов: {len(responses)}, {size / 1024:.1f} КБ")
+
+    api = bot.KufarAPI()
+    parse_timings = []
+    batches = []
+    for _ in range(args.runs):
+        batches = []
+        for query, body in responses:
+            started = time.perf_counter()
+            batches.append(
+                api._parse_ads(bot.KufarAPI._decode_response(body), query))
+            parse_timings.append(time.perf_counter() - started)
+    report("разбор ответа", parse_timings)
+
+    merge_timings = []
+    unique = 0
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        collection = bot.AdCollection()
+        for ads in batches:
+            collection.extend(ads)
+        unique = len(collection.sorted_by_date())
+        merge_timings.append(time.perf_counter() - started)
+    report(f"дедупликация и сортировка ({unique})", merge_timings)
+
+
+if __name__ == "__main__":
+    main()
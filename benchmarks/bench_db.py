@@ -0,0 +1,184 @@
+"""Бенчмарк: задержка обработчиков при медленном диске.
+
+Моделирует обработчики, которые читают настройки пользователя и пишут
+историю поиска, пока фоновый сборщик сохраняет объявления. Медленный диск
+имитируется паузой на каждом COMMIT (--commit-delay, как fsync на
+перегруженном диске). Сравниваются режимы:
+
+    inline  — как раньше: новое соединение на каждый вызов прямо в цикле
+              событий
+    threads — bot.Database: писатель и пул читателей вне цикла, WAL;
+              каждая строка истории — отдельная транзакция
+    behind  — threads + SearchHistoryWriter: история копится в очереди и
+              пишется пачками
+
+    python benchmarks/bench_db.py --handlers 50 --commit-delay 0.02
+
+Печатает задержку чтения настроек и записи истории (сколько ее ждет
+обработчик), задержку цикла событий и число обработанных "апдейтов".
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import time
+from typing import List
+
+from common import (TMP_DIR, import_bot, monitor_loop_lag, percentile, report,
+                    synthetic_ads)
+
+bot = import_bot()
+
+MODES = ["inline", "threads", "behind"]
+
+
+def slow_commits(conn: sqlite3.Connection, delay: float):
+    """Каждый COMMIT задерживает поток соединения на delay сек."""
+    if delay:
+        conn.set_trace_callback(
+            lambda statement: statement == "COMMIT" and time.sleep(delay))
+
+
+class ThreadedDatabase(bot.Database):
+
+    commit_delay = 0.0
+
+    def _connection(self) -> sqlite3.Connection:
+        new = getattr(self._local, "conn", None) is None
+        conn = super()._connection()
+        if new:
+            slow_commits(conn, self.commit_delay)
+        return conn
+
+
+class InlineDatabase(ThreadedDatabase):
+    """Прежнее поведение: свежее соединение и запрос прямо в цикле событий"""
+
+    def _inline(self, func, args, write: bool):
+        with sqlite3.connect(self.db_name) as conn:
+            slow_commits(conn, self.commit_delay)
+            return func(conn, *args)
+
+    async def _read(self, func, *args):
+        return self._inline(func, args, False)
+
+    async def _write(self, func, *args):
+        return self._inline(func, args, True)
+
+
+async def handler_loop(database, save_history, user_ids: List[int],
+                       deadline: float, args, rnd: random.Random,
+                       read_timings: List[float], write_timings: List[float]):
+    """Один "обработчик": читает настройки, иногда пишет историю поиска"""
+    updates = 0
+    while time.perf_counter() < deadline:
+        user_id = rnd.choice(user_ids)
+        started = time.perf_counter()
+        await database.get_user_settings(user_id)
+        read_timings.append(time.perf_counter() - started)
+        if rnd.random() < args.write_share:
+            started = time.perf_counter()
+            await save_history(user_id, "hikikomori", 42)
+            write_timings.append(time.perf_counter() - started)
+        updates += 1
+        await asyncio.sleep(rnd.uniform(0, 2 * args.think))
+    return updates
+
+
+async def harvester_loop(database, ads, deadline: float, batch: int,
+                         pause: float):
+    """Фоновый сборщик: пачка объявлений после каждого ответа Kufar"""
+    while time.perf_counter() < deadline:
+        for start in range(0, len(ads), batch):
+            await asyncio.sleep(pause)
+            await database.upsert_ads("hikikomori", ads[start:start + batch])
+            if time.perf_counter() >= deadline:
+                return
+
+
+async def bench(mode: str, args):
+    cls = InlineDatabase if mode == "inline" else ThreadedDatabase
+    cls.commit_delay = args.commit_delay
+    database = cls(os.path.join(TMP_DIR, f"{mode}.db"))
+    writer = None
+    if mode == "behind":
+        writer = bot.SearchHistoryWriter(database)
+        writer.start()
+
+    async def save_history(user_id: int, query: str, results_count: int):
+        if writer is not None:
+            writer.add(user_id, query, results_count, "brand")
+        else:
+            await database.save_search_history(
+                [(user_id, query, results_count, "2024-01-01 00:00:00",
+                  "brand")])
+
+    user_ids = list(range(1, args.users + 1))
+    for user_id in user_ids:
+        await database.get_user_settings(user_id)
+    ads = synthetic_ads(args.ads, bot.SEARCH_QUERIES["hikikomori"])
+
+    lags: List[float] = []
+    read_timings: List[float] = []
+    write_timings: List[float] = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+    deadline = time.perf_counter() + args.seconds
+    rnd = random.Random(args.seed)
+    jobs = [
+        handler_loop(database, save_history, user_ids, deadline, args,
+                     random.Random(rnd.random()), read_timings, write_timings)
+        for _ in range(args.handlers)
+    ]
+    if args.harvest_batch:
+        jobs.append(harvester_loop(database, ads, deadline,
+                                   args.harvest_batch, args.harvest_pause))
+    results = await asyncio.gather(*jobs)
+    lag_task.cancel()
+    if writer is not None:
+        await writer.stop()
+    database.close()
+
+    updates = sum(results[:args.handlers])
+    lag_ms = [lag * 1000 for lag in lags]
+    print(f"\n{mode}: {updates} апдейтов за {args.seconds} сек. "
+          f"({updates / args.seconds:.0f}/сек.)")
+    report("  get_user_settings", read_timings)
+    report("  история поиска", write_timings)
+    if writer is not None:
+        stats = writer.stats()
+        print(f"  записано {stats['written']} строк за {stats['flushes']} "
+              f"транзакций")
+    print(f"  задержка цикла событий: p50={percentile(lag_ms, 50):.1f} мс  "
+          f"p99={percentile(lag_ms, 99):.1f} мс  "
+          f"max={max(lag_ms, default=0):.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--handlers", type=int, default=50,
+                        help="одновременных обработчиков")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--think", type=float, default=0.02,
+                        help="средняя пауза между апдейтами обработчика, сек.")
+    parser.add_argument("--write-share", type=float, default=0.2,
+                        help="доля апдейтов, которые пишут историю поиска")
+    parser.add_argument("--commit-delay", type=float, default=0.02,
+                        help="пауза на каждом COMMIT (медленный диск), сек.")
+    parser.add_argument("--ads", type=int, default=2000)
+    parser.add_argument("--harvest-batch", type=int, default=200,
+                        help="объявлений в пачке сборщика (0 — без сборщика)")
+    parser.add_argument("--harvest-pause", type=float, default=0.1,
+                        help="пауза сборщика между пачками, сек.")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    for mode in args.modes:
+        asyncio.run(bench(mode, args))
+
+
+if __name__ == "__main__":
+    main()
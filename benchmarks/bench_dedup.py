@@ -0,0 +1,78 @@
+"""Бенчмарк: дедупликация и сортировка объявлений.
+
+Сравнивает прежний способ (проверка `ad not in list` по всему списку) с
+AdCollection на растущем числе объявлений:
+
+    python benchmarks/bench_dedup.py --sizes 1000 5000 20000 50000
+"""
+import argparse
+import time
+from datetime import datetime
+
+from common import import_bot, legacy_dict, synthetic_ads
+
+bot = import_bot()
+
+# Прежний способ слишком медленный на больших объемах
+LEGACY_LIMIT = 20000
+
+
+def legacy_dedup(batches):
+    all_ads = []
+    for ads in batches:
+        for ad in ads:
+            if ad not in all_ads:
+                all_ads.append(ad)
+    all_ads.sort(key=lambda x: x.get("date", datetime.min), reverse=True)
+    return all_ads
+
+
+def collection_dedup(batches):
+    collection = bot.AdCollection()
+    for ads in batches:
+        collection.extend(ads)
+    return collection.sorted_by_date()
+
+
+def make_batches(size: int, duplicates: float, batch_size: int = 50):
+    """Пачки как из stream_ads: каждая отсортирована по дате, часть
+    объявлений повторяется (пересечение вариантов запроса)"""
+    ads = synthetic_ads(size, ["hikikomori", "hikikomori kai"])
+    repeated = ads[:int(size * duplicates)]
+    stream = sorted(ads + repeated, key=bot.ad_date_key, reverse=True)
+    return [stream[i:i + batch_size] for i in range(0, len(stream), batch_size)]
+
+
+def timed(func, batches):
+    started = time.perf_counter()
+    result = func(batches)
+    return time.perf_counter() - started, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes",
+                        type=int,
+                        nargs="+",
+                        default=[1000, 5000, 10000, 20000, 50000])
+    parser.add_argument("--duplicates", type=float, default=0.3)
+    args = parser.parse_args()
+
+    print(f"{'объявлений':>10} {'список, мс':>12} {'AdCollection, мс':>18} "
+          f"{'уникальных':>11}")
+    for size in args.sizes:
+        batches = make_batches(size, args.duplicates)
+        new_time, unique = timed(collection_dedup, batches)
+        if size <= LEGACY_LIMIT:
+            legacy_batches = [[legacy_dict(ad) for ad in ads]
+                              for ads in batches]
+            legacy_time, legacy_unique = timed(legacy_dedup, legacy_batches)
+            assert legacy_unique == unique
+            legacy = f"{legacy_time * 1000:12.1f}"
+        else:
+            legacy = f"{'—':>12}"
+        print(f"{size:>10} {legacy} {new_time * 1000:18.2f} {unique:>11}")
+
+
+if __name__ == "__main__":
+    main()
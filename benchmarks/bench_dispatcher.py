@@ -0,0 +1,307 @@
+"""Нагрузочный замер диспетчера aiogram на синтетических пользователях.
+
+Поднимает fake_telegram.py и fake_kufar.py отдельными процессами, направляет
+на них бота (TELEGRAM_API_SERVER, KUFAR_API_URLS) и прогоняет через
+dp.process_update сессии пользователей: /start, кнопка бренда, листание
+страниц, возврат в меню, свой поиск и статистика бренда. Пользователи
+работают одновременно, шаги одного пользователя идут по очереди, как в
+реальном чате:
+
+    python benchmarks/bench_dispatcher.py --users 200 --pages 3
+    python benchmarks/bench_dispatcher.py --users 1000 --telegram-latency 0.05 \\
+        --mirror "a:latency=0.1,jitter=0.05" --unlimited
+
+Печатает задержку по обработчикам (p50/p95/p99), пропускную способность,
+задержку цикла событий, чтения настроек из базы и число вызовов Bot API и
+запросов к Kufar.
+"""
+import argparse
+import asyncio
+import contextvars
+import json
+import os
+import random
+import time
+import urllib.request
+from collections import Counter, defaultdict
+from typing import Any, Dict, List
+
+from bench_search import DEFAULT_MIRRORS, start_fake
+from common import (ROOT, free_port, import_bot, monitor_loop_lag, percentile,
+                    report, start_server)
+
+FAKE_TELEGRAM = os.path.join(ROOT, "benchmarks", "fake_telegram.py")
+
+
+def fetch_stats(port: int) -> Dict[str, Any]:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats") as resp:
+        return json.loads(resp.read())
+
+
+class UpdateFactory:
+    """Синтетические апдейты Telegram от имени пользователей"""
+
+    def __init__(self, bot_module):
+        self.bot = bot_module
+        self._update_id = 0
+        self._message_id = 0
+
+    def _next_ids(self):
+        self._update_id += 1
+        self._message_id += 1
+        return self._update_id, self._message_id
+
+    @staticmethod
+    def _user(user_id: int) -> Dict[str, Any]:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message(self, user_id: int, text: str):
+        update_id, message_id = self._next_ids()
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text
+        }
+        if text.startswith("/"):
+            message["entities"] = [{
+                "type": "bot_command",
+                "offset": 0,
+                "length": len(text.split()[0])
+            }]
+        return self.bot.types.Update.to_object({
+            "update_id": update_id,
+            "message": message
+        })
+
+    def callback(self, user_id: int, data: str):
+        update_id, message_id = self._next_ids()
+        return self.bot.types.Update.to_object({
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+                    "text": "menu"
+                }
+            }
+        })
+
+
+def make_timer(bot_module, timings: Dict[str, List[float]]):
+    """Middleware, которое меряет время каждого обработчика"""
+    from aiogram.dispatcher.handler import current_handler
+    from aiogram.dispatcher.middlewares import BaseMiddleware
+
+    class HandlerTimer(BaseMiddleware):
+
+        @staticmethod
+        def _start(data: dict):
+            data["_bench_started"] = time.perf_counter()
+
+        @staticmethod
+        def _handler(data: dict):
+            handler = current_handler.get()
+            data["_bench_handler"] = getattr(handler, "__name__", "?")
+
+        @staticmethod
+        def _finish(data: dict):
+            name = data.get("_bench_handler", "без обработчика")
+            timings[name].append(time.perf_counter() -
+                                 data["_bench_started"])
+
+        async def on_pre_process_message(self, message, data: dict):
+            self._start(data)
+
+        async def on_process_message(self, message, data: dict):
+            self._handler(data)
+
+        async def on_post_process_message(self, message, results,
+                                          data: dict):
+            self._finish(data)
+
+        async def on_pre_process_callback_query(self, query, data: dict):
+            self._start(data)
+
+        async def on_process_callback_query(self, query, data: dict):
+            self._handler(data)
+
+        async def on_post_process_callback_query(self, query, results,
+                                                 data: dict):
+            self._finish(data)
+
+    return HandlerTimer()
+
+
+async def user_session(bot_module, factory: UpdateFactory, user_id: int,
+                       args, rnd: random.Random,
+                       base_context: contextvars.Context,
+                       errors: Counter) -> int:
+    dp = bot_module.dp
+    brand = rnd.choice(list(bot_module.SEARCH_QUERIES))
+    steps = [factory.message(user_id, "/start")]
+    steps.append(factory.callback(user_id,
+                                  bot_module.search_cb.new(query_key=brand)))
+    for page in range(2, args.pages + 2):
+        steps.append(
+            factory.callback(
+                user_id,
+                bot_module.pagination_cb.new(action="next", page_num=page)))
+    steps.append(factory.callback(user_id, "back_to_menu"))
+    steps.append(
+        factory.callback(user_id,
+                         bot_module.custom_search_cb.new(action="start")))
+    steps.append(factory.message(user_id, rnd.choice(args.custom)))
+    if rnd.random() < args.stats_share:
+        steps.append(factory.callback(user_id, "back_to_menu"))
+        steps.append(
+            factory.callback(user_id,
+                             bot_module.stats_cb.new(query_key=brand)))
+
+    for update in steps:
+        # Как executor: каждый апдейт в своей задаче с чистым контекстом,
+        # иначе StateFilter увидит закэшированное состояние прошлого апдейта
+        try:
+            await base_context.run(asyncio.create_task,
+                                   dp.process_update(update))
+        except Exception as e:
+            # executor тоже только логирует ошибку и идет дальше
+            errors[type(e).__name__] += 1
+        if args.think:
+            await asyncio.sleep(rnd.uniform(0, 2 * args.think))
+    return len(steps)
+
+
+async def bench(bot_module, args, kufar_port: int, telegram_port: int):
+    from aiogram import Bot, Dispatcher
+
+    dp = bot_module.dp
+    Bot.set_current(dp.bot)
+    Dispatcher.set_current(dp)
+    timings: Dict[str, List[float]] = defaultdict(list)
+    dp.middleware.setup(make_timer(bot_module, timings))
+    bot_module.kufar_session = bot_module.create_kufar_session()
+    bot_module.history_writer.start()
+
+    lags: List[float] = []
+    lag_task = asyncio.create_task(monitor_loop_lag(lags))
+    factory = UpdateFactory(bot_module)
+    rnd = random.Random(args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency or args.users)
+    base_context = contextvars.copy_context()
+    errors: Counter = Counter()
+
+    async def run_user(index: int) -> int:
+        async with semaphore:
+            return await user_session(bot_module, factory, 100000 + index,
+                                      args, random.Random(rnd.random()),
+                                      base_context, errors)
+
+    telegram_before = fetch_stats(telegram_port)
+    kufar_before = fetch_stats(kufar_port)
+    started = time.perf_counter()
+    try:
+        updates = sum(await asyncio.gather(*(run_user(index)
+                                             for index in range(args.users))))
+    finally:
+        elapsed = time.perf_counter() - started
+        lag_task.cancel()
+        await bot_module.kufar_session.close()
+        await bot_module.history_writer.stop()
+        await (await dp.bot.get_session()).close()
+
+    print(f"\n{args.users} пользователей, {updates} апдейтов за "
+          f"{elapsed:.1f} сек. ({updates / elapsed:.1f} апдейтов/сек.)\n")
+    print("Обработчики:")
+    for name, values in sorted(timings.items()):
+        report(f"  {name}", values)
+    if errors:
+        print("Ошибки обработчиков: " + ", ".join(
+            f"{name} x{count}" for name, count in errors.most_common()))
+
+    settings = bot_module.db.settings_cache.stats()
+    print(f"\nНастройки пользователей: {settings['hits']} из кэша, "
+          f"{settings['misses']} из базы")
+    history = bot_module.history_writer.stats()
+    print(f"История поиска: {history['written']} строк за "
+          f"{history['flushes']} транзакций")
+
+    lag_ms = [lag * 1000 for lag in lags]
+    print(f"\nЗадержка цикла событий: p50={percentile(lag_ms, 50):.1f} мс  "
+          f"p95={percentile(lag_ms, 95):.1f} мс  "
+          f"p99={percentile(lag_ms, 99):.1f} мс  "
+          f"max={max(lag_ms, default=0):.1f} мс")
+
+    telegram = fetch_stats(telegram_port)
+    calls = {
+        method: count - telegram_before.get(method, 0)
+        for method, count in telegram.items()
+    }
+    total_calls = sum(calls.values())
+    print(f"\nВызовы Bot API: {total_calls} "
+          f"({total_calls / max(1, updates):.1f} на апдейт)")
+    for method, count in sorted(calls.items(), key=lambda item: -item[1]):
+        print(f"  {method:<28} {count}")
+
+    kufar = fetch_stats(kufar_port)
+    kufar_requests = sum(
+        stats["requests"] - kufar_before.get(name, {}).get("requests", 0)
+        for name, stats in kufar.items())
+    print(f"\nЗапросы к Kufar: {kufar_requests}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=0,
+                        help="одновременных пользователей (0 — все сразу)")
+    parser.add_argument("--pages", type=int, default=3,
+                        help="сколько страниц листает пользователь")
+    parser.add_argument("--custom", nargs="+",
+                        default=["hikikomori kai", "enemy", "худи"])
+    parser.add_argument("--stats-share", type=float, default=0.3)
+    parser.add_argument("--think", type=float, default=0.0,
+                        help="средняя пауза между шагами, сек.")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--telegram-latency", type=float, default=0.03)
+    parser.add_argument("--total", type=int, default=500,
+                        help="объявлений в выдаче fake_kufar на запрос")
+    parser.add_argument("--brand-share", type=float, default=0.05)
+    parser.add_argument("--mirror", action="append",
+                        help="зеркало fake_kufar, см. fake_kufar.py")
+    parser.add_argument("--payload", help="сохраненный ответ API для fake")
+    parser.add_argument("--unlimited", action="store_true",
+                        help="снять ограничители частоты запросов к Kufar")
+    args = parser.parse_args()
+    args.mirror = args.mirror or DEFAULT_MIRRORS
+
+    kufar_port = free_port()
+    telegram_port = free_port()
+    kufar = start_fake(args, kufar_port)
+    telegram = start_server(
+        [FAKE_TELEGRAM, "--latency",
+         str(args.telegram_latency)], telegram_port)
+    try:
+        os.environ["TELEGRAM_API_SERVER"] = telegram.banner.partition("=")[2]
+        if args.unlimited:
+            for name in ("KUFAR_REQUESTS_PER_SECOND", "KUFAR_REQUESTS_BURST",
+                         "MIRROR_REQUESTS_PER_SECOND", "MIRROR_REQUESTS_BURST"):
+                os.environ.setdefault(name, "100000")
+        bot_module = import_bot()
+        asyncio.run(bench(bot_module, args, kufar_port, telegram_port))
+    finally:
+        for process in (kufar, telegram):
+            process.terminate()
+            process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Бенчмарк: поиск по локальному индексу FTS5 против живого запроса к Kufar.
+
+    python benchmarks/bench_fts.py --ads 50000 --query "hikikomori kai"
+
+Живой запрос отправляется на KUFAR_API_URL; без сети он будет пропущен.
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+from common import TMP_DIR, import_bot, report, synthetic_ads
+
+bot = import_bot()
+
+
+async def bench_index(args) -> None:
+    database = bot.Database(os.path.join(TMP_DIR, "fts.db"))
+    queries = [q for variants in bot.SEARCH_QUERIES.values() for q in variants]
+    ads = synthetic_ads(args.ads, queries, args.days)
+
+    started = time.perf_counter()
+    for brand, variants in bot.SEARCH_QUERIES.items():
+        await database.upsert_ads(
+            brand, [ad for ad in ads if ad.search_query in variants])
+    print(f"Индексировано {len(ads)} объявлений за "
+          f"{time.perf_counter() - started:.2f} сек.")
+
+    since = datetime.now() - timedelta(days=args.days)
+    timings = []
+    found = 0
+    for _ in range(args.runs):
+        started = time.perf_counter()
+        found = len(await database.search_titles(args.query, since))
+        timings.append(time.perf_counter() - started)
+    report(f"FTS5 '{args.query}' ({found})", timings)
+    database.close()
+
+
+async def bench_live(args) -> None:
+    timings = []
+    found = 0
+    async with bot.KufarAPI() as api:
+        for _ in range(args.live_runs):
+            started = time.perf_counter()
+            try:
+                found = len(await api.search_ads([args.query],
+                                                 args.days,
+                                                 use_cache=False))
+            except Exception as e:
+                print(f"Живой запрос не удался: {e}")
+                return
+            timings.append(time.perf_counter() - started)
+    report(f"Kufar API '{args.query}' ({found})", timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ads", type=int, default=50000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--runs", type=int, default=200)
+    parser.add_argument("--live-runs", type=int, default=3)
+    parser.add_argument("--query", default="hikikomori kai")
+    args = parser.parse_args()
+
+    asyncio.run(bench_index(args))
+    if args.live_runs > 0:
+        asyncio.run(bench_live(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Бенчмарк: классификация заголовков по брендам.
+
+Сравнивает прежний способ (для каждого варианта из SEARCH_QUERIES заново
+приводить заголовок к нижнему регистру и проверять подстроку) с одним
+проходом BrandMatcher по всем брендам сразу:
+
+    python benchmarks/bench_match.py --titles 10000 50000 --match-share 0.3
+"""
+import argparse
+import random
+import time
+
+from common import WORDS, import_bot
+
+bot = import_bot()
+
+
+def make_titles(count: int, match_share: float, seed: int = 1):
+    """Заголовки как в общей выдаче: часть содержит варианты брендов"""
+    rnd = random.Random(seed)
+    variants = [
+        variant for variants in bot.SEARCH_QUERIES.values()
+        for variant in variants
+    ]
+    titles = []
+    for _ in range(count):
+        words = rnd.sample(WORDS, 4)
+        if rnd.random() < match_share:
+            words.insert(rnd.randrange(5), rnd.choice(variants).title())
+        titles.append(" ".join(words).capitalize())
+    return titles
+
+
+def legacy_classify(titles):
+    result = []
+    for title in titles:
+        brands = []
+        for brand, variants in bot.SEARCH_QUERIES.items():
+            if any(variant.lower() in title.lower() for variant in variants):
+                brands.append(brand)
+        result.append(tuple(brands))
+    return result
+
+
+def matcher_classify(titles):
+    return [bot.brand_matcher.classify(title) for title in titles]
+
+
+def timed(func, titles):
+    started = time.perf_counter()
+    result = func(titles)
+    return time.perf_counter() - started, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--titles",
+                        type=int,
+                        nargs="+",
+                        default=[1000, 10000, 50000])
+    parser.add_argument("--match-share", type=float, default=0.3)
+    args = parser.parse_args()
+
+    print(f"{'заголовков':>10} {'по вариантам, мс':>17} "
+          f"{'BrandMatcher, мс':>17} {'ускорение':>10}")
+    for count in args.titles:
+        titles = make_titles(count, args.match_share)
+        legacy_time, legacy = timed(legacy_classify, titles)
+        matcher_time, matched = timed(matcher_classify, titles)
+        assert legacy == matched
+        print(f"{count:>10} {legacy_time * 1000:17.1f} "
+              f"{matcher_time * 1000:17.1f} "
+              f"{legacy_time / matcher_time:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""Бенчмарк памяти: объявления-словари против компактных bot.Ad.
+
+Считает через tracemalloc, сколько памяти занимают N объявлений (как в
+MemoryStorage у пользователя, листающего результаты):
+
+    python benchmarks/bench_memory.py --ads 10000
+"""
+import argparse
+import gc
+import tracemalloc
+
+from common import import_bot, legacy_dict, synthetic_ads
+
+bot = import_bot()
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    result = build()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    return result, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ads", type=int, default=10000)
+    args = parser.parse_args()
+
+    queries = [q for variants in bot.SEARCH_QUERIES.values() for q in variants]
+    source = synthetic_ads(args.ads, queries)
+    # Строки в обоих вариантах создаются заново, как после разбора JSON
+    raw = [(ad.id.encode(), ad.title.encode(), ad.price, ad.link.encode(),
+            ad.search_query.encode(), ad.ts) for ad in source]
+
+    def build_dicts():
+        return [
+            legacy_dict(
+                bot.Ad(ad_id.decode(), title.decode(), price, link.decode(),
+                       query.decode(), ts))
+            for ad_id, title, price, link, query, ts in raw
+        ]
+
+    def build_ads():
+        return [
+            bot.Ad(ad_id.decode(), title.decode(), price, link.decode(),
+                   query.decode(), ts)
+            for ad_id, title, price, link, query, ts in raw
+        ]
+
+    dicts, dict_size = measure(build_dicts)
+    ads, ad_size = measure(build_ads)
+
+    print(f"{args.ads} объявлений")
+    print(f"  словари: {dict_size / 1024:10.1f} КБ "
+          f"({dict_size / args.ads:.0f} байт на объявление)")
+    print(f"  Ad:      {ad_size / 1024:10.1f} КБ "
+          f"({ad_size / args.ads:.0f} байт на объявление)")
+    print(f"  экономия: x{dict_size / ad_size:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Бенчмарк: разбор ответа Kufar.
+
+Сравнивает прежний путь (json.loads всего ответа, как response.json(), и
+_parse_ads по полному дереву) с KufarAPI._decode_response (orjson, если
+установлен, и только нужные поля товара). Для каждого пути печатает время
+на ответ и память через tracemalloc: пик во время разбора и сколько
+остается, пока ответ держится до конца пагинации:
+
+    python benchmarks/bench_parse.py --products 50 --runs 500
+    python benchmarks/bench_parse.py --payload recorded.json
+
+--payload — сохраненный ответ API; без него ответ генерируется.
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from common import import_bot, report, synthetic_payload
+
+bot = import_bot()
+
+
+def legacy_decode(body: bytes):
+    return json.loads(body.decode("utf-8"))
+
+
+def measure_memory(decode, body: bytes):
+    """(пик, удерживаемый ответ) в байтах"""
+    gc.collect()
+    tracemalloc.start()
+    data = decode(body)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del data
+    return peak, retained
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--products", type=int, default=50)
+    parser.add_argument("--runs", type=int, default=500)
+    parser.add_argument("--payload", help="файл с сохраненным ответом API")
+    parser.add_argument("--query", default="hikikomori")
+    args = parser.parse_args()
+
+    if args.payload:
+        with open(args.payload, "rb") as f:
+            body = f.read()
+    else:
+        queries = [
+            q for variants in bot.SEARCH_QUERIES.values() for q in variants
+        ]
+        body = json.dumps(synthetic_payload(args.products, queries),
+                          ensure_ascii=False).encode("utf-8")
+
+    api = bot.KufarAPI()
+    decoder = "orjson" if bot.orjson is not None else "json"
+    paths = [
+        ("json + полный ответ", legacy_decode),
+        (f"{decoder} + нужные поля", bot.KufarAPI._decode_response),
+    ]
+    print(f"Ответ: {len(body) / 1024:.1f} КБ, "
+          f"{len(api._products(legacy_decode(body)))} товаров")
+
+    found = None
+    for name, decode in paths:
+        timings = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            ads = api._parse_ads(decode(body), args.query)
+            timings.append(time.perf_counter() - started)
+        if found is None:
+            found = len(ads)
+        assert len(ads) == found
+        report(name, timings)
+        peak, retained = measure_memory(decode, body)
+        print(f"{'':<32} пик={peak / 1024:9.1f} КБ  "
+              f"держит={retained / 1024:9.1f} КБ")
+
+
+if __name__ == "__main__":
+    main()
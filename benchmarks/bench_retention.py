@@ -0,0 +1,125 @@
+"""Бенчмарк обслуживания базы: архивация, инкрементальный VACUUM и
+задержка обычной работы во время него.
+
+Наполняет базу историей поиска за --days дней и объявлениями за
+--ads-days дней, затем запускает RetentionJob.run_once() и одновременно
+пишет историю и читает объявления, как обработчики:
+
+    python benchmarks/bench_retention.py --rows 500000 --ads 100000
+
+Печатает отчет задания (сколько строк ушло в архив, размер базы до и после,
+время) и задержку записи и чтения во время обслуживания и без него.
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+from typing import List
+
+from bench_rollup import synthetic_history
+from common import TMP_DIR, import_bot, report, synthetic_ads
+
+bot = import_bot()
+
+
+async def fill(database, args):
+    started = time.perf_counter()
+    batch = []
+    for row in synthetic_history(args.rows, args.days):
+        batch.append(row)
+        if len(batch) >= 5000:
+            await database.save_search_history(batch)
+            batch = []
+    await database.save_search_history(batch)
+
+    queries = bot.SEARCH_QUERIES["hikikomori"]
+    ads = synthetic_ads(args.ads, queries, args.ads_days)
+    for start in range(0, len(ads), 5000):
+        await database.upsert_ads("hikikomori", ads[start:start + 5000])
+    await database.checkpoint()
+    print(f"База наполнена за {time.perf_counter() - started:.1f} сек.")
+
+
+async def probe(database, stop: asyncio.Event, write_timings: List[float],
+                read_timings: List[float], interval: float = 0.01):
+    """Обработчик: запись истории и чтение объявлений бренда"""
+    since = datetime.now() - timedelta(days=10)
+    while not stop.is_set():
+        started = time.perf_counter()
+        await database.save_search_history([
+            (1, "Hikikomori Kai", 10,
+             datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), "brand")
+        ])
+        write_timings.append(time.perf_counter() - started)
+        started = time.perf_counter()
+        await database.get_ads("hikikomori", since, limit=50)
+        read_timings.append(time.perf_counter() - started)
+        await asyncio.sleep(interval)
+
+
+async def measure(database, seconds: float, job=None):
+    stop = asyncio.Event()
+    writes: List[float] = []
+    reads: List[float] = []
+    task = asyncio.create_task(probe(database, stop, writes, reads))
+    result = None
+    if job is not None:
+        result = await job.run_once()
+    else:
+        await asyncio.sleep(seconds)
+    stop.set()
+    await task
+    return writes, reads, result
+
+
+async def bench(args):
+    path = os.path.join(TMP_DIR, "retention.db")
+    database = bot.Database(path)
+    await fill(database, args)
+
+    writes, reads, _ = await measure(database, 3)
+    report("запись истории, фон", writes)
+    report("чтение объявлений, фон", reads)
+
+    job = bot.RetentionJob(database,
+                           history_days=args.history_days,
+                           ads_days=args.ads_retention_days,
+                           archive_dir=os.path.join(TMP_DIR, "archive"),
+                           pause=args.pause)
+    writes, reads, result = await measure(database, 0, job)
+    report("запись истории, обслуживание", writes)
+    report("чтение объявлений, обслуживание", reads)
+
+    print(f"\nВ архив: {result['history_archived']} строк истории, "
+          f"{result['ads_archived']} объявлений; почасовых сводок удалено "
+          f"{result['hourly_pruned']}; страниц освобождено "
+          f"{result['pages_released']}")
+    print(f"Размер базы: {result['size_before'] / 1048576:.1f} → "
+          f"{result['size_after'] / 1048576:.1f} МБ за "
+          f"{result['elapsed']:.1f} сек.")
+    archive_size = sum(
+        os.path.getsize(os.path.join(job.archive_dir, name))
+        for name in os.listdir(job.archive_dir))
+    print(f"Архивы: {len(os.listdir(job.archive_dir))} файлов, "
+          f"{archive_size / 1048576:.1f} МБ")
+    database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=300000,
+                        help="строк истории поиска")
+    parser.add_argument("--days", type=int, default=180,
+                        help="за сколько дней история")
+    parser.add_argument("--ads", type=int, default=50000)
+    parser.add_argument("--ads-days", type=int, default=120)
+    parser.add_argument("--history-days", type=int, default=90)
+    parser.add_argument("--ads-retention-days", type=int, default=60)
+    parser.add_argument("--pause", type=float, default=0.2)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Бенчмарк: популярность запросов из сводок против обхода search_history.
+
+Наполняет историю синтетическими поисками за --days дней (бренды и свои
+запросы с распределением Ципфа) через SearchHistoryWriter, как в боте, и
+сравнивает "топ за неделю" и "тренды за сутки" из сводок с тем же
+запросом к сырой истории:
+
+    python benchmarks/bench_rollup.py --rows 1000000 --days 30
+
+Время на запрос из сводок не должно расти с --rows.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from common import TMP_DIR, WORDS, import_bot, report
+
+bot = import_bot()
+
+
+def synthetic_history(rows: int, days: int, seed: int = 1):
+    """Строки (user_id, query, results_count, search_date, kind), старые
+    сначала"""
+    rnd = random.Random(seed)
+    brands = list(bot.BUTTON_NAMES.values())
+    custom = [" ".join(rnd.sample(WORDS, 2)) for _ in range(2000)]
+    weights = [1 / rank for rank in range(1, len(custom) + 1)]
+    start = datetime.utcnow() - timedelta(days=days)
+    step = days * 86400 / rows
+    for i in range(rows):
+        if rnd.random() < 0.6:
+            query, kind = rnd.choice(brands), "brand"
+        else:
+            query, kind = rnd.choices(custom, weights)[0], "custom"
+        date = start + timedelta(seconds=i * step)
+        yield (rnd.randrange(1, 5000), query, rnd.randrange(0, 300),
+               date.strftime("%Y-%m-%d %H:%M:%S"), kind)
+
+
+def raw_top(conn, hours: int, limit: int = 10):
+    """Тот же топ без сводок: группировка сырой истории за окно"""
+    since = (datetime.utcnow() -
+             timedelta(hours=hours)).strftime("%Y-%m-%d %H:%M:%S")
+    return conn.execute(
+        """
+        SELECT lower(query), COUNT(*), AVG(results_count) FROM search_history
+        WHERE search_date >= ?
+        GROUP BY lower(query) ORDER BY COUNT(*) DESC LIMIT ?
+        """, (since, limit)).fetchall()
+
+
+async def timed(timings, coro):
+    started = time.perf_counter()
+    result = await coro
+    timings.append(time.perf_counter() - started)
+    return result
+
+
+async def bench(args):
+    path = os.path.join(TMP_DIR, "rollup.db")
+    database = bot.Database(path)
+    writer = bot.SearchHistoryWriter(database, batch_size=args.batch)
+
+    started = time.perf_counter()
+    for row in synthetic_history(args.rows, args.days):
+        writer._queue.append(row)
+        if writer.queue_depth >= args.batch:
+            await writer.flush()
+    await writer.flush()
+    elapsed = time.perf_counter() - started
+    print(f"Записано {writer.written} строк пачками по {args.batch} за "
+          f"{elapsed:.1f} сек. ({writer.written / elapsed:.0f} строк/сек.)")
+
+    for name, hours in (("сутки", 24), ("неделя", 24 * 7)):
+        rollup_timings, raw_timings = [], []
+        for _ in range(args.runs):
+            top = await timed(rollup_timings,
+                              database.top_queries(hours, limit=10))
+            await timed(raw_timings,
+                        database._read(raw_top, hours))
+        report(f"сводки: топ, {name}", rollup_timings)
+        report(f"история: топ, {name}", raw_timings)
+        print(f"{'':<32} лидер: {top[0]['title']} ({top[0]['searches']})")
+
+    trending_timings = []
+    for _ in range(args.runs):
+        await timed(trending_timings, database.trending_queries(24))
+    report("сводки: тренды за сутки", trending_timings)
+
+    def sizes(conn):
+        return {
+            table: conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            for table in ("search_history", "search_stats_hourly",
+                          "search_stats_daily")
+        }
+
+    print("Строк в таблицах: " + ", ".join(
+        f"{table} {count}"
+        for table, count in (await database._read(sizes)).items()))
+    database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--batch", type=int, default=500)
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
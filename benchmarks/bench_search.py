@@ -0,0 +1,151 @@
+"""Сквозной бенчмарк поиска против локального fake_kufar.py.
+
+Поднимает fake_kufar.py в отдельном процессе (чтобы генерация ответов не
+мешала замерам), направляет на него бота через KUFAR_API_URLS и гоняет
+сценарии обработчиков:
+
+    single  — поиск по одному бренду (все варианты запроса)
+    custom  — свой запрос пользователя
+    recent  — новые объявления всех брендов за сутки
+    stats   — статистика бренда за 30 дней
+
+Для каждого сценария печатаются p50/p95/p99, пропускная способность и
+число запросов к зеркалам:
+
+    python benchmarks/bench_search.py --runs 20 --concurrency 4
+    python benchmarks/bench_search.py --flows single recent \\
+        --mirror "a:latency=0.08,jitter=0.03" --mirror "b:latency=0.2,errors=0.1"
+
+--unlimited снимает ограничители частоты бота (иначе действуют настройки
+KUFAR_REQUESTS_PER_SECOND и MIRROR_REQUESTS_PER_SECOND, как в проде).
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import time
+import urllib.request
+
+from common import ROOT, free_port, import_bot, report, start_server
+
+FAKE_SERVER = os.path.join(ROOT, "benchmarks", "fake_kufar.py")
+DEFAULT_MIRRORS = [
+    "a:latency=0.08,jitter=0.03",
+    "b:latency=0.15,jitter=0.05,errors=0.05",
+    "c:latency=0.3,jitter=0.1",
+]
+FLOWS = ["single", "custom", "recent", "stats"]
+
+
+def start_fake(args, port: int) -> subprocess.Popen:
+    command = [
+        FAKE_SERVER, "--total",
+        str(args.total), "--brand-share",
+        str(args.brand_share)
+    ]
+    for spec in args.mirror or DEFAULT_MIRRORS:
+        command += ["--mirror", spec]
+    if args.payload:
+        command += ["--payload", args.payload]
+    process = start_server(command, port)
+    # Первая строка вывода fake_kufar.py — готовый KUFAR_API_URLS
+    os.environ["KUFAR_API_URLS"] = process.banner.partition("=")[2]
+    return process
+
+
+def upstream_requests(port: int) -> int:
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/__stats") as resp:
+        stats = json.loads(resp.read())
+    return sum(mirror["requests"] for mirror in stats.values())
+
+
+async def run_flow(bot, flow: str, args):
+    """Один сценарий так, как его выполняет обработчик"""
+    queries = bot.SEARCH_QUERIES[args.brand]
+    if flow == "single":
+        async with bot.KufarAPI() as api:
+            return await api.search_ads(queries, args.days, use_cache=False)
+    if flow == "custom":
+        async with bot.KufarAPI() as api:
+            return await api.search_ads([args.custom],
+                                        args.days,
+                                        use_cache=False)
+    if flow == "recent":
+        bot.search_cache.clear()
+        async with bot.KufarAPI() as api:
+            return await api.search_all_ads_recent()
+    if flow == "stats":
+        bot.search_cache.clear()
+        return await bot.calculate_brand_statistics(queries, "BYN",
+                                                    args.brand)
+    raise ValueError(flow)
+
+
+async def bench_flow(bot, flow: str, args, port: int):
+    await run_flow(bot, flow, args)  # прогрев
+
+    timings = []
+
+    async def timed():
+        started = time.perf_counter()
+        await run_flow(bot, flow, args)
+        timings.append(time.perf_counter() - started)
+
+    requests_before = upstream_requests(port)
+    started = time.perf_counter()
+    for _ in range(args.runs):
+        await asyncio.gather(*(timed() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    requests = upstream_requests(port) - requests_before
+
+    report(f"{flow} x{args.concurrency}", timings)
+    print(f"{'':<32} {len(timings) / elapsed:.2f} сценариев/сек., "
+          f"{requests / len(timings):.1f} запросов к зеркалам на сценарий")
+
+
+async def bench(bot, args, port: int):
+    bot.kufar_session = bot.create_kufar_session()
+    try:
+        for flow in args.flows:
+            await bench_flow(bot, flow, args, port)
+    finally:
+        await bot.kufar_session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--flows", nargs="+", choices=FLOWS, default=FLOWS)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--brand", default="hikikomori")
+    parser.add_argument("--custom", default="hikikomori kai")
+    parser.add_argument("--days", type=int, default=10)
+    parser.add_argument("--total", type=int, default=500,
+                        help="объявлений в выдаче fake_kufar на запрос")
+    parser.add_argument("--brand-share", type=float, default=0.05)
+    parser.add_argument("--mirror", action="append",
+                        help="зеркало fake_kufar, см. fake_kufar.py")
+    parser.add_argument("--payload", help="сохраненный ответ API для fake")
+    parser.add_argument("--unlimited", action="store_true",
+                        help="снять ограничители частоты запросов")
+    args = parser.parse_args()
+
+    port = free_port()
+    process = start_fake(args, port)
+    try:
+        if args.unlimited:
+            for name in ("KUFAR_REQUESTS_PER_SECOND", "KUFAR_REQUESTS_BURST",
+                         "MIRROR_REQUESTS_PER_SECOND", "MIRROR_REQUESTS_BURST"):
+                os.environ.setdefault(name, "100000")
+        bot = import_bot()
+        print(f"Зеркала: {', '.join(bot.kufar_mirror_urls())}")
+        asyncio.run(bench(bot, args, port))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+"""Общие помощники для бенчмарков.
+
+bot.py импортируется без запуска бота: подставляется тестовый токен,
+отдельная временная база и отключается фоновый сборщик.
+"""
+import asyncio
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TMP_DIR = tempfile.mkdtemp(prefix="kufar-bench-")
+
+WORDS = [
+    "худи", "футболка", "лонгслив", "джинсы", "куртка", "кофта", "оригинал",
+    "новая", "размер", "черная", "hoodie", "tee", "longsleeve", "jacket",
+    "black", "oversize", "limited", "vintage", "size", "xl"
+]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(command: List[str], port: int) -> subprocess.Popen:
+    """Запускает вспомогательный сервер (fake_kufar.py, fake_telegram.py)
+    отдельным процессом и ждет, пока он начнет принимать соединения.
+    Первая строка его вывода возвращается в process.banner"""
+    process = subprocess.Popen([sys.executable] + command +
+                               ["--port", str(port)],
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.DEVNULL,
+                               text=True)
+    process.banner = process.stdout.readline().strip()
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"{command[0]} не запустился")
+
+
+def import_bot():
+    os.environ.setdefault("BOT_TOKEN", "123456789:BENCHMARK")
+    os.environ.setdefault("DATABASE_PATH", os.path.join(TMP_DIR, "users.db"))
+    os.environ.setdefault("HARVESTER_ENABLED", "0")
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    import bot
+    return bot
+
+
+def synthetic_ads(count: int,
+                  queries: List[str],
+                  days_back: int = 30,
+                  seed: int = 1) -> list:
+    """Объявления (bot.Ad) со случайными заголовками"""
+    bot = import_bot()
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    ads = []
+    for i in range(count):
+        query = rnd.choice(queries)
+        words = rnd.sample(WORDS, 3)
+        words.insert(rnd.randrange(4), query)
+        date = now - timedelta(seconds=rnd.randrange(days_back * 86400))
+        ads.append(
+            bot.Ad(str(100000000 + i), " ".join(words).capitalize(),
+                   float(rnd.randrange(0, 50000)) / 100,
+                   f"https://www.kufar.by/item/{100000000 + i}", query,
+                   bot.datetime_to_ts(date)))
+    return ads
+
+
+def synthetic_product(rnd: random.Random,
+                      ad_id: int,
+                      title: str,
+                      date: datetime,
+                      price: float,
+                      parameters: int = 12) -> Dict[str, Any]:
+    """Товар в формате rendered-paginated: кроме полей, которые читает бот,
+    есть parameters параметров, картинки и данные продавца"""
+    return {
+        "ad_id": ad_id,
+        "subject": title,
+        "list_time": date.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "price_byn": str(int(price * 100)),
+        "price_usd": str(int(price * 30)),
+        "currency": "BYR",
+        "ad_link": f"https://www.kufar.by/item/{ad_id}",
+        "body_short": " ".join(rnd.choices(WORDS, k=25)),
+        "category": str(rnd.choice([8110, 8100, 17010])),
+        "company_ad": False,
+        "paid_services": {"halva": False, "highlight": rnd.random() < 0.1,
+                          "polepos": False, "ribbons": None},
+        "phone_hidden": True,
+        "remuneration_type": "0",
+        "type": "sell",
+        "account_id": str(rnd.randrange(10 ** 7)),
+        "account_parameters": [
+            {"pl": "Имя", "vl": rnd.choice(WORDS), "p": "name", "v": ""},
+            {"pl": "Адрес", "vl": "Минск", "p": "address", "v": ""},
+        ],
+        "ad_parameters": [{
+            "pl": f"Параметр {i}",
+            "vl": rnd.choice(WORDS),
+            "p": f"param_{i}",
+            "v": str(rnd.randrange(1000)),
+            "pu": "",
+            "g": [{"gi": i, "gl": "Основное", "go": i, "po": i}]
+        } for i in range(parameters)],
+        "images": [{
+            "id": str(rnd.randrange(10 ** 10)),
+            "media_storage": "rms",
+            "path": f"adim1/{rnd.randrange(10 ** 12):012x}.jpg",
+            "yams_storage": True
+        } for _ in range(rnd.randrange(1, 8))],
+        "show_parameters": {"show_call": True, "show_chat": True,
+                            "show_import_link": False,
+                            "show_web_shop_link": False},
+    }
+
+
+def synthetic_payload(count: int,
+                      queries: List[str],
+                      days_back: int = 1,
+                      seed: int = 1) -> Dict[str, Any]:
+    """Страница ответа rendered-paginated из count товаров"""
+    rnd = random.Random(seed)
+    ads = [
+        synthetic_product(rnd, int(ad.id), ad.title, ad.date, ad.price)
+        for ad in synthetic_ads(count, queries, days_back, seed)
+    ]
+    return {
+        "ads": ads,
+        "pagination": {
+            "pages": [{"label": "self", "num": 1, "token": None},
+                      {"label": "next", "num": 2, "token": "eyJ0IjoiYWJzIn0="}]
+        },
+        "total": count * 20
+    }
+
+
+def legacy_dict(ad) -> Dict[str, Any]:
+    """Объявление в прежнем формате словаря из _parse_ads"""
+    return {
+        "id": ad.id,
+        "title": ad.title,
+        "price": ad.price,
+        "link": ad.link,
+        "search_query": ad.search_query,
+        "date": ad.date
+    }
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def monitor_loop_lag(lags: List[float], interval: float = 0.01):
+    """Насколько позже заказанного просыпается цикл событий"""
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(time.perf_counter() - started - interval)
+
+
+def report(name: str, timings: List[float]):
+    """Печатает p50/p95/p99 и среднее (timings — в секундах)"""
+    if not timings:
+        print(f"{name:<32} нет замеров")
+        return
+    ms = [t * 1000 for t in timings]
+    print(f"{name:<32} n={len(ms):<6} "
+          f"mean={statistics.mean(ms):9.3f} ms  "
+          f"p50={percentile(ms, 50):9.3f} ms  "
+          f"p95={percentile(ms, 95):9.3f} ms  "
+          f"p99={percentile(ms, 99):9.3f} ms")
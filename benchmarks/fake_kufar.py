@@ -0,0 +1,221 @@
+"""Локальная замена Kufar API для замеров без сети.
+
+Отвечает на search-api/v2 и search-api/v1 (rendered-paginated) от имени
+нескольких зеркал; у каждого зеркала свои задержка, доля ошибок и размер
+ответа:
+
+    python benchmarks/fake_kufar.py --port 8080 \\
+        --mirror "a:latency=0.08,jitter=0.03" \\
+        --mirror "b:latency=0.15,errors=0.05,status=429" \\
+        --mirror "c:latency=0.3,parameters=30"
+
+Зеркало a доступно по http://127.0.0.1:8080/a/search-api/v2/search/rendered-paginated,
+бот направляется на зеркала через KUFAR_API_URLS. Параметры зеркала:
+
+    latency    средняя задержка ответа, сек.
+    jitter     разброс задержки (равномерно ±jitter), сек.
+    errors     доля ответов с ошибкой
+    status     статус ошибки (500 по умолчанию, 429 — с Retry-After: 1)
+    parameters число ad_parameters у товара (размер ответа)
+
+С запросом выдача содержит total объявлений с query в заголовке, равномерно
+за days_back дней, новые сверху, по курсору. Без запроса (режим firehose)
+отдается общая лента, где только доля brand_share заголовков содержит
+варианты брендов. --payload отдает сохраненный ответ API на любой запрос.
+GET /__stats возвращает число запросов и ошибок по зеркалам.
+"""
+import argparse
+import asyncio
+import json
+import random
+import zlib
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+from common import WORDS, import_bot, synthetic_product
+
+PATHS = [
+    "/{mirror}/search-api/v2/search/rendered-paginated",
+    "/{mirror}/search-api/v1/search/rendered-paginated",
+]
+
+
+class MirrorProfile:
+    """Поведение одного зеркала"""
+
+    def __init__(self,
+                 latency: float = 0.05,
+                 jitter: float = 0.0,
+                 errors: float = 0.0,
+                 status: int = 500,
+                 parameters: int = 12):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.status = status
+        self.parameters = parameters
+
+    @classmethod
+    def parse(cls, spec: str) -> Tuple[str, "MirrorProfile"]:
+        """'a:latency=0.1,errors=0.05' -> ('a', MirrorProfile(...))"""
+        name, _, options = spec.partition(":")
+        kwargs = {}
+        for option in filter(None, options.split(",")):
+            key, _, value = option.partition("=")
+            kwargs[key.strip()] = (int(value) if key.strip() in
+                                   ("status", "parameters") else float(value))
+        return name.strip(), cls(**kwargs)
+
+    def delay(self, rnd: random.Random) -> float:
+        return max(0.0, self.latency + rnd.uniform(-self.jitter, self.jitter))
+
+
+class FakeKufar:
+    """Генератор выдачи и обработчик запросов"""
+
+    def __init__(self,
+                 profiles: Dict[str, MirrorProfile],
+                 variants: List[str],
+                 total: int = 500,
+                 days_back: int = 30,
+                 brand_share: float = 0.05,
+                 payload: Optional[bytes] = None,
+                 seed: int = 1):
+        self.profiles = profiles
+        self.variants = variants
+        self.total = total
+        self.days_back = days_back
+        self.brand_share = brand_share
+        self.payload = payload
+        self.rnd = random.Random(seed)
+        self.now = datetime.utcnow()
+        # Страницы кэшируются: генерация не должна мерить сама себя
+        self._pages: Dict[tuple, bytes] = {}
+        self.stats = {
+            name: {"requests": 0, "errors": 0} for name in profiles
+        }
+
+    def _title(self, rnd: random.Random, query: str) -> str:
+        words = rnd.sample(WORDS, 3)
+        if not query and rnd.random() < self.brand_share:
+            query = rnd.choice(self.variants)
+        if query:
+            words.insert(rnd.randrange(4), query.title())
+        return " ".join(words).capitalize()
+
+    def render_page(self, query: str, offset: int, size: int,
+                    parameters: int) -> bytes:
+        key = (query, offset, size, parameters)
+        body = self._pages.get(key)
+        if body is not None:
+            return body
+
+        rnd = random.Random(f"{query}:{offset}")
+        step = self.days_back * 86400 / max(1, self.total)
+        first_id = 100000000 + zlib.crc32(query.encode()) % 1000 * 100000
+        ads = []
+        for index in range(offset, min(self.total, offset + size)):
+            ad_id = first_id + index
+            ads.append(
+                synthetic_product(rnd, ad_id, self._title(rnd, query),
+                                  self.now - timedelta(seconds=index * step),
+                                  rnd.randrange(0, 50000) / 100, parameters))
+        pages = [{"label": "self", "num": offset // size + 1, "token": None}]
+        if offset + size < self.total:
+            pages.append({
+                "label": "next",
+                "num": offset // size + 2,
+                "token": str(offset + size)
+            })
+        body = json.dumps({
+            "ads": ads,
+            "pagination": {"pages": pages},
+            "total": self.total
+        }, ensure_ascii=False).encode("utf-8")
+        self._pages[key] = body
+        return body
+
+    async def handle(self, request: web.Request) -> web.Response:
+        name = request.match_info["mirror"]
+        profile = self.profiles.get(name)
+        if profile is None:
+            return web.Response(status=404)
+        stats = self.stats[name]
+        stats["requests"] += 1
+
+        await asyncio.sleep(profile.delay(self.rnd))
+        if self.rnd.random() < profile.errors:
+            stats["errors"] += 1
+            headers = {"Retry-After": "1"} if profile.status == 429 else None
+            return web.Response(status=profile.status, headers=headers)
+
+        if self.payload is not None:
+            body = self.payload
+        else:
+            query = request.query.get("query", "")
+            size = int(request.query.get("size", 50))
+            offset = int(request.query.get("cursor", 0) or 0)
+            body = self.render_page(query, offset, size, profile.parameters)
+        return web.Response(body=body, content_type="application/json")
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(self.stats)
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        for path in PATHS:
+            app.router.add_get(path, self.handle)
+        app.router.add_get("/__stats", self.handle_stats)
+        return app
+
+
+def mirror_urls(host: str, port: int, names: List[str]) -> List[str]:
+    """Адреса зеркал для KUFAR_API_URLS"""
+    return [
+        f"http://{host}:{port}/{name}/search-api/v2/search/rendered-paginated"
+        for name in names
+    ]
+
+
+def parse_profiles(specs: List[str]) -> Dict[str, MirrorProfile]:
+    profiles = dict(MirrorProfile.parse(spec) for spec in specs)
+    return profiles or {"a": MirrorProfile()}
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--mirror", action="append", default=[],
+                        help="имя:параметр=значение,...")
+    parser.add_argument("--total", type=int, default=500,
+                        help="объявлений в выдаче на запрос")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--brand-share", type=float, default=0.05)
+    parser.add_argument("--payload", help="файл с сохраненным ответом API")
+    args = parser.parse_args(argv)
+
+    bot = import_bot()
+    variants = [
+        q for variants in bot.SEARCH_QUERIES.values() for q in variants
+    ]
+    payload = None
+    if args.payload:
+        with open(args.payload, "rb") as f:
+            payload = f.read()
+
+    profiles = parse_profiles(args.mirror)
+    fake = FakeKufar(profiles, variants, args.total, args.days,
+                     args.brand_share, payload)
+    print("KUFAR_API_URLS=" +
+          ",".join(mirror_urls(args.host, args.port, list(profiles))),
+          flush=True)
+    web.run_app(fake.create_app(), host=args.host, port=args.port,
+                print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Локальная замена Telegram Bot API для нагрузочных замеров.
+
+Отвечает на методы Bot API правдоподобными объектами (Message, True),
+помнит удаленные сообщения по чатам (повторное удаление — 400, как у
+Telegram) и считает вызовы по методам:
+
+    python benchmarks/fake_telegram.py --port 8081 --latency 0.03
+
+Бот направляется на сервер через TELEGRAM_API_SERVER=http://127.0.0.1:8081.
+GET /__stats возвращает число вызовов по методам.
+"""
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+from typing import Any, Dict, List, Optional, Set
+
+from aiohttp import web
+
+# Методы, которые возвращают отправленное или измененное сообщение
+MESSAGE_METHODS = {
+    "sendmessage", "sendphoto", "editmessagetext", "editmessagereplymarkup",
+    "editmessagecaption"
+}
+
+
+class FakeTelegram:
+
+    def __init__(self, latency: float = 0.03, jitter: float = 0.01,
+                 seed: int = 1):
+        self.latency = latency
+        self.jitter = jitter
+        self.rnd = random.Random(seed)
+        self.calls: Counter = Counter()
+        self._next_message_id = 1000
+        self._deleted: Dict[int, Set[int]] = {}
+
+    def _message(self, chat_id: int, message_id: Optional[int],
+                 params: Dict[str, Any]) -> Dict[str, Any]:
+        if message_id is None:
+            self._next_message_id += 1
+            message_id = self._next_message_id
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": 1, "is_bot": True, "first_name": "bench"},
+            "text": params.get("text", "")
+        }
+
+    def call(self, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        method = method.lower()
+        self.calls[method] += 1
+        chat_id = int(params.get("chat_id", 0) or 0)
+        message_id = params.get("message_id")
+        message_id = int(message_id) if message_id else None
+
+        if method == "getme":
+            result: Any = {"id": 1, "is_bot": True, "first_name": "bench",
+                           "username": "bench_bot"}
+        elif method in MESSAGE_METHODS:
+            result = self._message(chat_id, message_id, params)
+        elif method == "deletemessage":
+            deleted = self._deleted.setdefault(chat_id, set())
+            if not message_id or message_id in deleted:
+                return {"ok": False, "error_code": 400,
+                        "description": "Bad Request: message to delete "
+                                       "not found"}
+            deleted.add(message_id)
+            result = True
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        params: Dict[str, Any] = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        await asyncio.sleep(
+            max(0.0, self.latency + self.rnd.uniform(-self.jitter,
+                                                     self.jitter)))
+        response = self.call(request.match_info["method"], params)
+        return web.json_response(response,
+                                 status=response.get("error_code", 200))
+
+    async def handle_stats(self, request: web.Request) -> web.Response:
+        return web.json_response(dict(self.calls))
+
+    def create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/__stats", self.handle_stats)
+        return app
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.03)
+    parser.add_argument("--jitter", type=float, default=0.01)
+    args = parser.parse_args(argv)
+
+    fake = FakeTelegram(args.latency, args.jitter)
+    print(f"TELEGRAM_API_SERVER=http://{args.host}:{args.port}", flush=True)
+    web.run_app(fake.create_app(), host=args.host, port=args.port,
+                print=None, access_log=None)
+
+
+if __name__ == "__main__":
+    main()
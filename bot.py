@@ -1,25 +1,52 @@
 import asyncio
+import gzip
+import inspect
 import logging
 import os
 import sqlite3
 import json
 import random
+import re
+import sys
+import threading
 import time
 import aiohttp
 import requests
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Dict, Any, List, Tuple
+from typing import (Optional, Dict, Any, List, Tuple, AsyncIterator, Callable,
+                    Awaitable, Iterable, Iterator, FrozenSet)
 
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.types import ParseMode, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardRemove
 from aiogram.utils import executor
 from aiogram.utils.callback_data import CallbackData
 
+# orjson необязателен: если установлен, ответы Kufar разбираются быстрее
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 BOT_TOKEN = os.environ.get("BOT_TOKEN", "")
+# Свой сервер Bot API (локальный telegram-bot-api или
+# benchmarks/fake_telegram.py для нагрузочных замеров)
+TELEGRAM_API_SERVER = os.environ.get("TELEGRAM_API_SERVER", "")
+DATABASE_PATH = os.environ.get("DATABASE_PATH", "users.db")
+
+# Логгер настраивается до первого сетевого запроса (get_currency_rates)
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger(__name__)
 
 # Настройки API Kufar
 KUFAR_API_URL = "https://api.kufar.by/search-api/v2/search/rendered-paginated"
@@ -27,6 +54,132 @@ ALT_KUFAR_API_URLS = [
     "https://api.kufar.by/search-api/v1/search/rendered-paginated",
     "https://cre-api.kufar.by/search-api/v2/search/rendered-paginated",
 ]
+# Свой список зеркал через запятую (первое — основное), например локальный
+# benchmarks/fake_kufar.py для замеров без сети
+if os.environ.get("KUFAR_API_URLS"):
+    KUFAR_API_URL, *ALT_KUFAR_API_URLS = [
+        url.strip() for url in os.environ["KUFAR_API_URLS"].split(",")
+        if url.strip()
+    ]
+KUFAR_HEADERS = {
+    "User-Agent":
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
+    "Accept": "application/json",
+    "Origin": "https://kufar.by",
+    "Referer": "https://kufar.by/",
+}
+# Сколько вариантов запроса одного поиска запрашивать одновременно
+KUFAR_MAX_CONCURRENCY = int(os.environ.get("KUFAR_MAX_CONCURRENCY", "4"))
+KUFAR_REQUEST_TIMEOUT = 10
+# Общий лимит частоты запросов к Kufar (запросов в секунду и размер "пачки"),
+# чтобы параллельные поиски оставались вежливыми к API
+KUFAR_REQUESTS_PER_SECOND = float(
+    os.environ.get("KUFAR_REQUESTS_PER_SECOND", "10"))
+KUFAR_REQUESTS_BURST = int(os.environ.get("KUFAR_REQUESTS_BURST", "30"))
+# Свой лимит частоты для каждого зеркала. При 429/5xx частота зеркала
+# снижается вдвое (но не ниже MIRROR_MIN_RATE) и плавно восстанавливается
+# после успешных ответов
+MIRROR_REQUESTS_PER_SECOND = float(
+    os.environ.get("MIRROR_REQUESTS_PER_SECOND", "10"))
+MIRROR_REQUESTS_BURST = int(os.environ.get("MIRROR_REQUESTS_BURST", "30"))
+MIRROR_MIN_RATE = 0.2
+# Предохранитель зеркала: после BREAKER_FAILURE_THRESHOLD ошибок подряд
+# зеркало пропускается BREAKER_RESET_TIMEOUT сек., затем получает один
+# пробный запрос. Неудачная проба удваивает паузу (до BREAKER_MAX_RESET_TIMEOUT)
+BREAKER_FAILURE_THRESHOLD = 3
+BREAKER_RESET_TIMEOUT = 30
+BREAKER_MAX_RESET_TIMEOUT = 300
+# Ранжирование зеркал: EWMA задержки и доли ошибок (вес нового замера) и
+# фоновая проба каждые MIRROR_PROBE_INTERVAL сек. (0 — без проб)
+MIRROR_EWMA_ALPHA = 0.2
+MIRROR_PROBE_INTERVAL = int(os.environ.get("MIRROR_PROBE_INTERVAL", "120"))
+# Сколько брендов одновременно сканирует экран "Последние объявления"
+RECENT_SCAN_CONCURRENCY = int(os.environ.get("RECENT_SCAN_CONCURRENCY", "20"))
+# Размер страницы выдачи и предельная глубина пагинации одного запроса.
+# Выдача отсортирована по дате, поэтому обход страниц останавливается, как
+# только страница выходит за пределы периода поиска
+KUFAR_PAGE_SIZE = int(os.environ.get("KUFAR_PAGE_SIZE", "50"))
+KUFAR_MAX_PAGES = int(os.environ.get("KUFAR_MAX_PAGES", "20"))
+# Хеджирование запросов: если зеркало не ответило за KUFAR_HEDGE_DELAY сек.
+# (ориентир — p95 задержки), тот же запрос параллельно уходит на следующее
+# зеркало. KUFAR_MAX_HEDGES ограничивает число таких доп. запросов,
+# KUFAR_HEDGE_DELAY=0 отключает хеджирование
+KUFAR_HEDGE_DELAY = float(os.environ.get("KUFAR_HEDGE_DELAY", "1.5"))
+KUFAR_MAX_HEDGES = int(os.environ.get("KUFAR_MAX_HEDGES", "1"))
+# Пул соединений общей сессии: лимит соединений на хост, keep-alive и
+# время жизни DNS-кэша (сек.)
+KUFAR_CONNECTIONS_PER_HOST = int(
+    os.environ.get("KUFAR_CONNECTIONS_PER_HOST", "20"))
+KUFAR_KEEPALIVE_TIMEOUT = 60
+KUFAR_DNS_CACHE_TTL = 300
+# Кэш результатов поиска: время жизни записи (сек.), число записей и общий
+# предел числа объявлений во всех записях (ограничивает память)
+SEARCH_CACHE_TTL = int(os.environ.get("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = 256
+SEARCH_CACHE_MAX_ADS = 50000
+# Фоновый сборщик объявлений по брендам из SEARCH_QUERIES: раз в
+# HARVEST_INTERVAL сек. обходит все бренды за HARVEST_DAYS_BACK дней
+HARVESTER_ENABLED = os.environ.get("HARVESTER_ENABLED", "1") == "1"
+HARVEST_INTERVAL = int(os.environ.get("HARVEST_INTERVAL", "600"))
+HARVEST_DAYS_BACK = 30
+# Режим сборщика: "search" — отдельный поиск по каждому варианту запроса,
+# "firehose" — одна лента новых объявлений (sort=lst.d) с локальной
+# классификацией по брендам, число запросов не зависит от числа брендов
+HARVEST_MODE = os.environ.get("HARVEST_MODE", "search")
+# Категории ленты через запятую (пусто — все объявления), глубина первого
+# прохода без водяного знака (дней) и предел страниц за один проход
+FIREHOSE_CATEGORIES = [
+    category.strip()
+    for category in os.environ.get("FIREHOSE_CATEGORIES", "").split(",")
+    if category.strip()
+]
+FIREHOSE_BACKFILL_DAYS = int(os.environ.get("FIREHOSE_BACKFILL_DAYS", "1"))
+FIREHOSE_MAX_PAGES = int(os.environ.get("FIREHOSE_MAX_PAGES", "200"))
+# Кассета запросов к Kufar: "record" — дописывать параметры и сырые ответы
+# в KUFAR_CASSETTE_PATH (gzip NDJSON), "replay" — отвечать из нее без сети
+# с исходными задержками, пусто — обычная работа
+KUFAR_CASSETTE_MODE = os.environ.get("KUFAR_CASSETTE_MODE", "")
+KUFAR_CASSETTE_PATH = os.environ.get("KUFAR_CASSETTE_PATH",
+                                     "kufar_cassette.ndjson.gz")
+# SQLite работает вне цикла событий: записи идут по очереди через один
+# поток-писатель на долгоживущем соединении, чтения — через пул из
+# DB_READERS потоков. База в режиме WAL, так что чтения не ждут записей.
+# DB_BUSY_TIMEOUT — сколько сек. соединение ждет блокировку
+DB_READERS = int(os.environ.get("DB_READERS", "4"))
+DB_BUSY_TIMEOUT = 5
+# Настройки пользователей в памяти: сколько пользователей держать (LRU).
+# Записи обновляются при каждом изменении настроек и не устаревают
+SETTINGS_CACHE_MAX_USERS = int(
+    os.environ.get("SETTINGS_CACHE_MAX_USERS", "10000"))
+# История поиска пишется в базу в фоне пачками: раз в
+# HISTORY_FLUSH_INTERVAL сек. или как только в очереди HISTORY_FLUSH_ROWS
+# строк. При HISTORY_MAX_QUEUED строк (база недоступна) старые строки
+# отбрасываются
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "5"))
+HISTORY_FLUSH_ROWS = int(os.environ.get("HISTORY_FLUSH_ROWS", "500"))
+HISTORY_MAX_QUEUED = 100000
+# Обслуживание базы (раз в RETENTION_INTERVAL сек., 0 — выключено): строки
+# search_history старше HISTORY_RETENTION_DAYS дней и объявления старше
+# ADS_RETENTION_DAYS дней (не меньше глубины сборщика) переносятся в
+# помесячные архивы gzip NDJSON в ARCHIVE_DIR (пусто — удаляются без
+# архива), почасовые сводки хранятся ROLLUP_HOURLY_RETENTION_DAYS дней.
+# Работа идет пачками по RETENTION_BATCH_ROWS строк и по VACUUM_STEP_PAGES
+# страниц инкрементального VACUUM с паузой RETENTION_PAUSE сек. между ними,
+# чтобы не занимать поток-писатель надолго
+RETENTION_INTERVAL = int(os.environ.get("RETENTION_INTERVAL", "86400"))
+HISTORY_RETENTION_DAYS = int(os.environ.get("HISTORY_RETENTION_DAYS", "90"))
+ADS_RETENTION_DAYS = max(HARVEST_DAYS_BACK,
+                         int(os.environ.get("ADS_RETENTION_DAYS", "60")))
+ROLLUP_HOURLY_RETENTION_DAYS = 14
+ARCHIVE_DIR = os.environ.get("ARCHIVE_DIR", "archive")
+RETENTION_BATCH_ROWS = 2000
+VACUUM_STEP_PAGES = 1000
+RETENTION_PAUSE = 0.2
+# База, созданная до инкрементального VACUUM, переводится на него полным
+# VACUUM: файл переписывается целиком, все записи ждут до конца. Поэтому
+# перевод выполняется только по VACUUM_ON_STARTUP=1 при запуске, до приема
+# апдейтов; без него старые строки удаляются, но файл не уменьшается
+VACUUM_ON_STARTUP = os.environ.get("VACUUM_ON_STARTUP", "0") == "1"
 
 
 # Функция для получения актуальных курсов валют (BYN к другим валютам)
@@ -818,12 +971,10 @@ depth_cb = CallbackData("depth", "value")
 currency_cb = CallbackData("currency", "value")
 language_cb = CallbackData("language", "value")
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-logger = logging.getLogger(__name__)
-
-bot = Bot(token=BOT_TOKEN, parse_mode=ParseMode.HTML)
+bot = Bot(token=BOT_TOKEN,
+          parse_mode=ParseMode.HTML,
+          server=(TelegramAPIServer.from_base(TELEGRAM_API_SERVER)
+                  if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION))
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 
@@ -832,196 +983,2192 @@ recent_cb = CallbackData("recent", "action")
 custom_search_cb = CallbackData("custom", "action")
 
 
-class Database:
+class BrandMatcher:
+    """Классификатор заголовков по всем вариантам запросов брендов.
+
+    Все варианты собраны в одно скомпилированное регулярное выражение, так
+    что заголовок просматривается один раз для всех брендов сразу. Варианты,
+    входящие в другие ("enemy" в "enemy in reflection", "hikikomori" в
+    "hikikomori kai"), заранее замкнуты: найденный длинный вариант сразу
+    дает и все вложенные в него. Варианты, которые могут начинаться внутри
+    найденного совпадения (конец одного — начало другого), досматриваются
+    отдельно, так что результат совпадает с проверкой каждой подстроки.
+    """
+
+    def __init__(self, queries: Dict[str, List[str]]):
+        self._brand_order = list(queries)
+        self._variant_brands: Dict[str, List[str]] = {}
+        for brand, variants in queries.items():
+            for variant in variants:
+                brands = self._variant_brands.setdefault(
+                    sys.intern(variant.lower()), [])
+                if brand not in brands:
+                    brands.append(brand)
+
+        # Длинные варианты первыми: на каждой позиции берется самый длинный
+        variants = sorted(self._variant_brands, key=len, reverse=True)
+        self._closure: Dict[str, FrozenSet[str]] = {
+            variant: frozenset(other for other in variants if other in variant)
+            for variant in variants
+        }
+        self._overlapping: Dict[str, Tuple[str, ...]] = {
+            variant: tuple(other for other in variants
+                           if self._overlaps(variant, other))
+            for variant in variants
+        }
+        self._pattern = re.compile("|".join(map(re.escape, variants)))
+        self._brands_cache: Dict[FrozenSet[str], Tuple[str, ...]] = {}
+
+    @staticmethod
+    def _overlaps(first: str, second: str) -> bool:
+        """Может ли second начинаться внутри first и выходить за его конец"""
+        if second in first:
+            return False
+        return any(first[-size:] == second[:size]
+                   for size in range(1, min(len(first), len(second))))
+
+    def is_variant(self, search_query: str) -> bool:
+        return search_query.lower() in self._variant_brands
+
+    def match(self, text_lower: str) -> FrozenSet[str]:
+        """Все варианты запросов, входящие в уже приведенный к нижнему
+        регистру текст"""
+        matched = self._pattern.findall(text_lower)
+        if not matched:
+            return frozenset()
+
+        found = set()
+        for variant in matched:
+            found |= self._closure[variant]
+        for variant in matched:
+            for other in self._overlapping[variant]:
+                if other not in found and other in text_lower:
+                    found |= self._closure[other]
+        return frozenset(found)
+
+    def brands(self, variants: FrozenSet[str]) -> Tuple[str, ...]:
+        """Ключи брендов для найденных вариантов в порядке SEARCH_QUERIES.
+
+        Кортежи кэшируются, поэтому объявления с одинаковым набором брендов
+        делят один объект.
+        """
+        brands = self._brands_cache.get(variants)
+        if brands is None:
+            matched = {
+                brand
+                for variant in variants
+                for brand in self._variant_brands[variant]
+            }
+            brands = tuple(
+                sys.intern(brand) for brand in self._brand_order
+                if brand in matched)
+            self._brands_cache[variants] = brands
+        return brands
+
+    def classify(self, title: str) -> Tuple[str, ...]:
+        return self.brands(self.match(title.lower()))
+
+
+brand_matcher = BrandMatcher(SEARCH_QUERIES)
+
+
+def datetime_to_ts(date: datetime) -> int:
+    """Дата объявления (наивная, UTC) -> unix-время"""
+    return int(date.replace(tzinfo=timezone.utc).timestamp())
+
+
+def ts_to_datetime(ts: int) -> datetime:
+    """unix-время -> наивная дата в UTC, как в ответах API"""
+    return datetime.fromtimestamp(ts, timezone.utc).replace(tzinfo=None)
+
+
+class Ad:
+    """Компактная запись объявления.
+
+    Строки бренда и запроса интернируются (общие для всех объявлений),
+    дата хранится как unix-время (0 — дата неизвестна), стандартная ссылка
+    на объявление не хранится, а вычисляется по id. В brands — ключи всех
+    брендов, чьи варианты запросов нашлись в заголовке (см. BrandMatcher).
+    """
+
+    __slots__ = ("id", "title", "price", "search_query", "ts", "brand",
+                 "brands", "_link")
+
+    def __init__(self,
+                 ad_id: str,
+                 title: str,
+                 price: float,
+                 link: Optional[str],
+                 search_query: Optional[str],
+                 ts: int = 0,
+                 brand: Optional[str] = None,
+                 brands: Tuple[str, ...] = ()):
+        self.id = ad_id
+        self.title = title
+        self.price = price
+        self.search_query = sys.intern(search_query) if search_query else None
+        self.ts = ts
+        self.brand = sys.intern(brand) if brand else None
+        self.brands = brands
+        self._link = None if link in self._default_links(ad_id) else link
+
+    @staticmethod
+    def _default_links(ad_id: str) -> Tuple[str, str]:
+        return (f"https://www.kufar.by/item/{ad_id}",
+                f"https://kufar.by/item/{ad_id}")
+
+    @property
+    def link(self) -> str:
+        return self._link or f"https://kufar.by/item/{self.id}"
+
+    @property
+    def date(self) -> Optional[datetime]:
+        return ts_to_datetime(self.ts) if self.ts else None
+
+    @property
+    def brand_display(self) -> Optional[str]:
+        return BUTTON_NAMES.get(self.brand, self.brand) if self.brand else None
+
+    def with_brand(self, brand: str) -> "Ad":
+        """Копия объявления с подписью бренда"""
+        return Ad(self.id, self.title, self.price, self._link,
+                  self.search_query, self.ts, brand, self.brands)
+
+    def __repr__(self) -> str:
+        return f"Ad({self.id!r}, {self.title!r}, ts={self.ts})"
+
+
+class SettingsCache:
+    """Настройки пользователей в памяти процесса (LRU).
+
+    Настройки меняются только через меню настроек, поэтому записи не
+    устаревают: Database обновляет их при каждой записи (write-through).
+    Счетчик generation растет с каждым изменением — чтение из базы, начатое
+    до изменения, не должно положить в кэш старое значение.
+    """
+
+    def __init__(self, max_users: int = SETTINGS_CACHE_MAX_USERS):
+        self.max_users = max_users
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        settings = self._entries.get(user_id)
+        if settings is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        # Копия: обработчик не должен менять запись кэша
+        return dict(settings)
+
+    def add(self, user_id: int, settings: Dict[str, Any], generation: int):
+        """Кладет настройки, прочитанные из базы при данном generation"""
+        if (self.max_users <= 0 or generation != self.generation
+                or user_id in self._entries):
+            return
+        self._entries[user_id] = dict(settings)
+        while len(self._entries) > self.max_users:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def update(self, user_id: int, column: str, value: Any):
+        """Записывает в кэш настройку, уже сохраненную в базе"""
+        self.generation += 1
+        settings = self._entries.get(user_id)
+        if settings is not None:
+            settings[column] = value
+
+    def clear(self):
+        self._entries.clear()
+        self.generation += 1
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
 
-    def __init__(self, db_name: str = "users.db"):
-        self.db_name = db_name
-        self._init_db()
 
-    def _init_db(self):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
+class Database:
+    """SQLite-хранилище бота, которое не блокирует цикл событий.
+
+    Все записи выполняются по очереди в одном потоке-писателе на
+    долгоживущем соединении, каждая в своей транзакции. Чтения идут через
+    пул потоков, у каждого из которых свое соединение. В режиме WAL чтения
+    не ждут записей, поэтому медленный fsync задерживает только следующую
+    запись, а не обработчики.
+    """
+
+    DEFAULT_SETTINGS = {"language": "ru", "currency": "BYN", "days_back": 10}
+    SETTINGS_COLUMNS = ("language", "currency", "days_back")
+    # Таблица сводки и длина префикса search_date, который служит ее bucket
+    ROLLUP_TABLES = (("search_stats_hourly", 13), ("search_stats_daily", 10))
+    # Кнопка бренда (как она пишется в историю) -> ключ SEARCH_QUERIES
+    BRAND_BY_BUTTON = {name.lower(): key for key, name in BUTTON_NAMES.items()}
+
+    def __init__(self,
+                 db_name: str = DATABASE_PATH,
+                 readers: int = DB_READERS,
+                 settings_cache: Optional[SettingsCache] = None):
+        self.db_name = db_name
+        self.settings_cache = (settings_cache if settings_cache is not None
+                               else SettingsCache())
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1,
+                                          thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(max_workers=max(1, readers),
+                                           thread_name_prefix="db-reader")
+        # Схема создается синхронно: модуль импортируется до запуска цикла
+        self._writer.submit(self._execute, self._init_db, (), True).result()
+
+    def _connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока, открывается при первом обращении"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # check_same_thread=False нужен только для close() из другого
+            # потока: соединением пользуется один поток
+            conn = sqlite3.connect(self.db_name,
+                                   timeout=DB_BUSY_TIMEOUT,
+                                   check_same_thread=False)
+            # В WAL synchronous=NORMAL не портит базу при сбое и не делает
+            # fsync на каждый коммит (только на контрольных точках)
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _execute(self, func: Callable, args: tuple, write: bool):
+        conn = self._connection()
+        if not write:
+            return func(conn, *args)
+        # Коммит при успехе, откат при исключении
+        with conn:
+            return func(conn, *args)
+
+    async def _read(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._execute, func,
+                                          args, False)
+
+    async def _write(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._execute, func,
+                                          args, True)
+
+    def close(self):
+        """Дожидается начатых запросов и закрывает все соединения"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+    def _init_db(self, conn: sqlite3.Connection):
+        # Освобожденные страницы возвращаются порциями (incremental_vacuum).
+        # На новой базе действует сразу, старую переводит
+        # enable_incremental_vacuum() (VACUUM_ON_STARTUP)
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL сохраняется в файле базы: читатели больше не ждут писателя
+        conn.execute("PRAGMA journal_mode = WAL")
+        cursor = conn.cursor()
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS user_settings (
+                user_id INTEGER PRIMARY KEY,
+                language TEXT DEFAULT 'ru',
+                currency TEXT DEFAULT 'BYN',
+                days_back INTEGER DEFAULT 10,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS search_history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                query TEXT,
+                results_count INTEGER,
+                search_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                kind TEXT
+            )
+        """)
+        # kind ("brand" — кнопка бренда, "custom" — свой запрос) появился
+        # позже: у старых строк он NULL
+        history_columns = [
+            row[1] for row in cursor.execute(
+                "PRAGMA table_info(search_history)").fetchall()
+        ]
+        if "kind" not in history_columns:
+            cursor.execute("ALTER TABLE search_history ADD COLUMN kind TEXT")
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_search_history_date ON search_history (search_date)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_search_history_user ON search_history (user_id, search_date)"
+        )
+        # Сводки популярности: число поисков и сумма результатов по
+        # запросу за час (bucket "YYYY-MM-DD HH") и за день ("YYYY-MM-DD").
+        # Обновляются в той же транзакции, что и запись истории
+        rollups_exist = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_stats_daily'"
+        ).fetchone()
+        for table, _ in self.ROLLUP_TABLES:
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {table} (
+                    bucket TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    searches INTEGER NOT NULL DEFAULT 0,
+                    results_total INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (bucket, kind, query)
+                ) WITHOUT ROWID
+            """)
+        if not rollups_exist:
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS user_settings (
-                    user_id INTEGER PRIMARY KEY,
-                    language TEXT DEFAULT 'ru',
-                    currency TEXT DEFAULT 'BYN',
-                    days_back INTEGER DEFAULT 10,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+                SELECT strftime('%Y-%m-%d %H', search_date), query, kind,
+                       COUNT(*), SUM(COALESCE(results_count, 0))
+                FROM search_history
+                WHERE search_date IS NOT NULL AND query IS NOT NULL
+                GROUP BY 1, 2, 3
             """)
+            self._update_rollups(conn, cursor.fetchall())
+        # Объявления: одна строка на пару (объявление, бренд)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ads (
+                ad_id TEXT NOT NULL,
+                brand TEXT NOT NULL,
+                title TEXT,
+                price REAL DEFAULT 0,
+                link TEXT,
+                search_query TEXT,
+                list_time INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (ad_id, brand)
+            )
+        """)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ads_brand_list_time ON ads (brand, list_time)"
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_ads_list_time ON ads (list_time)"
+        )
+        # Полнотекстовый индекс заголовков: одна строка на объявление,
+        # rowid = числовой id объявления. unicode61 приводит к нижнему
+        # регистру и кириллицу, и латиницу
+        fts_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'ads_fts'").fetchone()
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS ads_fts USING fts5(
+                title,
+                tokenize = "unicode61 remove_diacritics 2"
+            )
+        """)
+        cursor.execute("DROP TRIGGER IF EXISTS ads_fts_insert")
+        cursor.execute("""
+            CREATE TRIGGER ads_fts_insert AFTER INSERT ON ads
+            WHEN new.ad_id GLOB '[0-9]*' BEGIN
+                DELETE FROM ads_fts WHERE rowid = CAST(new.ad_id AS INTEGER);
+                INSERT INTO ads_fts (rowid, title)
+                VALUES (CAST(new.ad_id AS INTEGER), new.title);
+            END
+        """)
+        cursor.execute("DROP TRIGGER IF EXISTS ads_fts_update")
+        cursor.execute("""
+            CREATE TRIGGER ads_fts_update AFTER UPDATE OF title ON ads
+            WHEN new.ad_id GLOB '[0-9]*' BEGIN
+                DELETE FROM ads_fts WHERE rowid = CAST(new.ad_id AS INTEGER);
+                INSERT INTO ads_fts (rowid, title)
+                VALUES (CAST(new.ad_id AS INTEGER), new.title);
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS ads_fts_delete AFTER DELETE ON ads
+            WHEN NOT EXISTS (SELECT 1 FROM ads WHERE ad_id = old.ad_id) BEGIN
+                DELETE FROM ads_fts WHERE rowid = CAST(old.ad_id AS INTEGER);
+            END
+        """)
+        if not fts_exists:
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS search_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER,
-                    query TEXT,
-                    results_count INTEGER,
-                    search_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
+                INSERT OR REPLACE INTO ads_fts (rowid, title)
+                SELECT CAST(ad_id AS INTEGER), title FROM ads
+                WHERE ad_id GLOB '[0-9]*'
             """)
-            conn.commit()
-
-    def get_user_settings(self, user_id: int) -> Dict[str, Any]:
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT language, currency, days_back FROM user_settings WHERE user_id = ?",
-                (user_id, ))
-            result = cursor.fetchone()
-
-            if result:
-                return {
-                    "language": result[0],
-                    "currency": result[1],
-                    "days_back": result[2]
-                }
-            else:
-                cursor.execute(
-                    "INSERT INTO user_settings (user_id, language, currency, days_back) VALUES (?, ?, ?, ?)",
-                    (user_id, "ru", "BYN", 10))
-                conn.commit()
-                return {"language": "ru", "currency": "BYN", "days_back": 10}
-
-    def update_language(self, user_id: int, language: str):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE user_settings SET language = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
-                (language, user_id))
-            if cursor.rowcount == 0:
-                cursor.execute(
-                    "INSERT INTO user_settings (user_id, language) VALUES (?, ?)",
-                    (user_id, language))
-            conn.commit()
-
-    def update_currency(self, user_id: int, currency: str):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE user_settings SET currency = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
-                (currency, user_id))
-            if cursor.rowcount == 0:
-                cursor.execute(
-                    "INSERT INTO user_settings (user_id, currency) VALUES (?, ?)",
-                    (user_id, currency))
-            conn.commit()
-
-    def update_days_back(self, user_id: int, days_back: int):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE user_settings SET days_back = ?, updated_at = CURRENT_TIMESTAMP WHERE user_id = ?",
-                (days_back, user_id))
-            if cursor.rowcount == 0:
-                cursor.execute(
-                    "INSERT INTO user_settings (user_id, days_back) VALUES (?, ?)",
-                    (user_id, days_back))
-            conn.commit()
-
-    def save_search_history(self, user_id: int, query: str,
-                            results_count: int):
-        with sqlite3.connect(self.db_name) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO search_history (user_id, query, results_count) VALUES (?, ?, ?)",
-                (user_id, query, results_count))
-            conn.commit()
+        # Самое новое list_time, уже сохраненное для поискового запроса
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS sync_watermarks (
+                query TEXT PRIMARY KEY,
+                list_time INTEGER NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    @staticmethod
+    def _select_settings(conn: sqlite3.Connection,
+                         user_id: int) -> Optional[Dict[str, Any]]:
+        result = conn.execute(
+            "SELECT language, currency, days_back FROM user_settings WHERE user_id = ?",
+            (user_id, )).fetchone()
+        if result is None:
+            return None
+        return {
+            "language": result[0],
+            "currency": result[1],
+            "days_back": result[2]
+        }
+
+    @classmethod
+    def _insert_settings(cls, conn: sqlite3.Connection, user_id: int):
+        conn.execute(
+            "INSERT OR IGNORE INTO user_settings (user_id, language, currency, days_back) VALUES (?, ?, ?, ?)",
+            (user_id, cls.DEFAULT_SETTINGS["language"],
+             cls.DEFAULT_SETTINGS["currency"],
+             cls.DEFAULT_SETTINGS["days_back"]))
+
+    @classmethod
+    def _update_setting(cls, conn: sqlite3.Connection, user_id: int,
+                        column: str, value: Any):
+        if column not in cls.SETTINGS_COLUMNS:
+            raise ValueError(f"Неизвестная настройка: {column}")
+        conn.execute(
+            f"""
+            INSERT INTO user_settings (user_id, {column}) VALUES (?, ?)
+            ON CONFLICT (user_id) DO UPDATE SET
+                {column} = excluded.{column},
+                updated_at = CURRENT_TIMESTAMP
+            """, (user_id, value))
+
+    async def get_user_settings(self, user_id: int) -> Dict[str, Any]:
+        settings = self.settings_cache.get(user_id)
+        if settings is not None:
+            return settings
+
+        generation = self.settings_cache.generation
+        settings = await self._read(self._select_settings, user_id)
+        if settings is None:
+            await self._write(self._insert_settings, user_id)
+            settings = dict(self.DEFAULT_SETTINGS)
+        self.settings_cache.add(user_id, settings, generation)
+        return settings
+
+    async def _update_settings(self, user_id: int, column: str, value: Any):
+        await self._write(self._update_setting, user_id, column, value)
+        self.settings_cache.update(user_id, column, value)
+
+    async def update_language(self, user_id: int, language: str):
+        await self._update_settings(user_id, "language", language)
+
+    async def update_currency(self, user_id: int, currency: str):
+        await self._update_settings(user_id, "currency", currency)
+
+    async def update_days_back(self, user_id: int, days_back: int):
+        await self._update_settings(user_id, "days_back", days_back)
+
+    @classmethod
+    def _history_key(cls, query: str,
+                     kind: Optional[str]) -> Tuple[str, str]:
+        """(вид, ключ) запроса из истории: "brand" и ключ SEARCH_QUERIES для
+        кнопки бренда, "custom" и запрос в нижнем регистре для своего.
+
+        Вид записывается при поиске; только у строк, записанных до
+        появления столбца kind, он угадывается по тексту кнопки"""
+        key = " ".join(query.lower().split())
+        if kind is None:
+            kind = "brand" if key in cls.BRAND_BY_BUTTON else "custom"
+        if kind == "brand":
+            return kind, cls.BRAND_BY_BUTTON.get(key, key)
+        return kind, key
+
+    @classmethod
+    def _update_rollups(cls, conn: sqlite3.Connection, groups: List[Tuple]):
+        """Добавляет в сводки группы (search_date, query, kind, searches,
+        results_total); search_date достаточно с точностью до часа"""
+        for table, width in cls.ROLLUP_TABLES:
+            totals: Dict[Tuple[str, str, str], List[int]] = {}
+            for search_date, query, kind, searches, results_total in groups:
+                kind, key = cls._history_key(query, kind)
+                total = totals.setdefault((search_date[:width], kind, key),
+                                          [0, 0])
+                total[0] += searches
+                total[1] += results_total or 0
+            conn.executemany(
+                f"""
+                INSERT INTO {table} (bucket, kind, query, searches, results_total)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (bucket, kind, query) DO UPDATE SET
+                    searches = searches + excluded.searches,
+                    results_total = results_total + excluded.results_total
+                """, [(*key, searches, results_total)
+                      for key, (searches, results_total) in totals.items()])
+
+    @classmethod
+    def _insert_search_history(cls, conn: sqlite3.Connection,
+                               rows: List[Tuple]):
+        conn.executemany(
+            "INSERT INTO search_history (user_id, query, results_count, search_date, kind) VALUES (?, ?, ?, ?, ?)",
+            rows)
+        cls._update_rollups(
+            conn, [(search_date, query, kind, 1, results_count)
+                   for _, query, results_count, search_date, kind in rows])
+
+    async def save_search_history(self, rows: List[Tuple]):
+        """Записывает пачку строк (user_id, query, results_count,
+        search_date, kind) и обновляет сводки одной транзакцией"""
+        if rows:
+            await self._write(self._insert_search_history, rows)
+
+    @staticmethod
+    def _select_rollup(conn: sqlite3.Connection, table: str, since: str,
+                       until: Optional[str],
+                       kind: Optional[str]) -> Dict[Tuple[str, str], Tuple]:
+        cursor = conn.execute(
+            f"""
+            SELECT kind, query, SUM(searches), SUM(results_total)
+            FROM {table}
+            WHERE bucket >= ? AND (? IS NULL OR bucket < ?)
+                AND (? IS NULL OR kind = ?)
+            GROUP BY kind, query
+            """, (since, until, until, kind, kind))
+        return {(row[0], row[1]): (row[2], row[3])
+                for row in cursor.fetchall()}
+
+    @staticmethod
+    def _rollup_entry(kind: str, query: str, searches: int,
+                      results_total: int) -> Dict[str, Any]:
+        return {
+            "kind": kind,
+            "query": query,
+            "title": BUTTON_NAMES.get(query, query) if kind == "brand"
+            else query,
+            "searches": searches,
+            "avg_results": results_total / searches if searches else 0.0
+        }
+
+    async def top_queries(self,
+                          hours: int = 24 * 7,
+                          kind: Optional[str] = None,
+                          limit: int = 10) -> List[Dict[str, Any]]:
+        """Самые частые запросы за последние hours часов из сводок (без
+        обхода истории). До двух суток считаются по часам, дольше — по дням,
+        тогда окно начинается с начала первого дня. kind — "brand",
+        "custom" или None (все)"""
+        since = datetime.utcnow() - timedelta(hours=hours)
+        if hours <= 48:
+            table, since_key = "search_stats_hourly", since.strftime(
+                "%Y-%m-%d %H")
+        else:
+            table, since_key = "search_stats_daily", since.strftime("%Y-%m-%d")
+        totals = await self._read(self._select_rollup, table, since_key, None,
+                                  kind)
+        ranked = sorted(totals.items(), key=lambda item: (-item[1][0],
+                                                          item[0][1]))
+        return [
+            self._rollup_entry(key_kind, query, searches, results_total)
+            for (key_kind, query), (searches, results_total) in ranked[:limit]
+        ]
+
+    async def trending_queries(self,
+                               hours: int = 24,
+                               baseline_days: int = 7,
+                               kind: Optional[str] = None,
+                               limit: int = 10,
+                               min_searches: int = 2) -> List[Dict[str, Any]]:
+        """Запросы, которые за последние hours часов ищут чаще обычного.
+
+        Обычная частота — среднее по дневным сводкам за baseline_days дней
+        до окна, приведенное к длине окна. growth = (поиски + 1) /
+        (ожидаемые + 1), так что новые запросы не делятся на ноль.
+        """
+        now = datetime.utcnow()
+        window_start = now - timedelta(hours=hours)
+        recent = await self._read(self._select_rollup, "search_stats_hourly",
+                                  window_start.strftime("%Y-%m-%d %H"), None,
+                                  kind)
+        baseline = await self._read(
+            self._select_rollup, "search_stats_daily",
+            (window_start - timedelta(days=baseline_days)).strftime(
+                "%Y-%m-%d"), window_start.strftime("%Y-%m-%d"), kind)
+        scale = hours / (baseline_days * 24)
+
+        trending = []
+        for (key_kind, query), (searches, results_total) in recent.items():
+            if searches < min_searches:
+                continue
+            expected = baseline.get((key_kind, query), (0, 0))[0] * scale
+            entry = self._rollup_entry(key_kind, query, searches,
+                                       results_total)
+            entry["expected"] = expected
+            entry["growth"] = (searches + 1) / (expected + 1)
+            trending.append(entry)
+        trending.sort(key=lambda entry: (-entry["growth"], -entry["searches"]))
+        return trending[:limit]
+
+    @staticmethod
+    def _upsert_ads(conn: sqlite3.Connection, rows: List[Tuple]):
+        conn.executemany(
+            """
+            INSERT INTO ads (ad_id, brand, title, price, link, search_query, list_time)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (ad_id, brand) DO UPDATE SET
+                title = excluded.title,
+                price = excluded.price,
+                link = excluded.link,
+                search_query = COALESCE(excluded.search_query,
+                                        ads.search_query),
+                list_time = excluded.list_time,
+                updated_at = CURRENT_TIMESTAMP
+            """, rows)
+
+    async def upsert_ads(self, brand: str, ads: List[Ad]) -> int:
+        rows = [(ad.id, brand, ad.title, ad.price, ad.link, ad.search_query,
+                 ad.ts) for ad in ads if ad.ts]
+        if not rows:
+            return 0
+        await self._write(self._upsert_ads, rows)
+        return len(rows)
+
+    @staticmethod
+    def _row_to_ad(row: Tuple) -> Ad:
+        ad_id, brand, title, price, link, search_query, list_time = row
+        return Ad(ad_id, title, price or 0, link, search_query, list_time,
+                  brand, brand_matcher.classify(title))
+
+    @classmethod
+    def _select_ads(cls, conn: sqlite3.Connection, brand: str, since_ts: int,
+                    limit: int, offset: int) -> List[Ad]:
+        cursor = conn.execute(
+            """
+            SELECT ad_id, brand, title, price, link, search_query, list_time
+            FROM ads WHERE brand = ? AND list_time >= ?
+            ORDER BY list_time DESC LIMIT ? OFFSET ?
+            """, (brand, since_ts, limit, offset))
+        return [cls._row_to_ad(row) for row in cursor.fetchall()]
+
+    async def get_ads(self,
+                      brand: str,
+                      since: datetime,
+                      limit: int = -1,
+                      offset: int = 0) -> List[Ad]:
+        """Объявления бренда новее since, новые сверху"""
+        return await self._read(self._select_ads, brand,
+                                datetime_to_ts(since), limit, offset)
+
+    @classmethod
+    def _select_recent_ads(cls, conn: sqlite3.Connection,
+                           since_ts: int) -> List[Ad]:
+        cursor = conn.execute(
+            """
+            SELECT ad_id, brand, title, price, link, search_query, list_time
+            FROM ads WHERE list_time >= ?
+            ORDER BY list_time DESC
+            """, (since_ts, ))
+        return [cls._row_to_ad(row) for row in cursor.fetchall()]
+
+    async def get_recent_ads(self, since: datetime) -> List[Ad]:
+        """Объявления всех брендов новее since, новые сверху"""
+        return await self._read(self._select_recent_ads,
+                                datetime_to_ts(since))
+
+    @staticmethod
+    def _fts_query(text: str) -> Optional[str]:
+        """Запрос FTS5: каждое слово как префикс, все слова обязательны"""
+        words = re.findall(r"\w+", text.lower())
+        if not words:
+            return None
+        return " AND ".join(f'"{word}"*' for word in words)
+
+    @classmethod
+    def _select_titles(cls, conn: sqlite3.Connection, text: str,
+                       fts_query: str, since_ts: int) -> List[Ad]:
+        cursor = conn.execute(
+            """
+            SELECT a.ad_id, a.brand, a.title, a.price, a.link,
+                   a.search_query, a.list_time
+            FROM ads_fts f
+            JOIN ads a ON a.ad_id = CAST(f.rowid AS TEXT)
+            WHERE ads_fts MATCH ? AND a.list_time >= ?
+            GROUP BY a.ad_id
+            ORDER BY a.list_time DESC
+            """, (fts_query, since_ts))
+
+        needle = text.lower()
+        ads = []
+        for row in cursor.fetchall():
+            ad = cls._row_to_ad(row)
+            if needle in ad.title.lower():
+                ad.search_query = text
+                ads.append(ad)
+        return ads
+
+    async def search_titles(self, text: str, since: datetime) -> List[Ad]:
+        """Поиск по заголовкам сохраненных объявлений через FTS5.
+
+        Индекс находит кандидатов по словам, затем оставляем только
+        объявления, где запрос входит в заголовок целиком — как в _parse_ads.
+        """
+        fts_query = self._fts_query(text)
+        if not fts_query:
+            return []
+        return await self._read(self._select_titles, text, fts_query,
+                                datetime_to_ts(since))
+
+    @staticmethod
+    def _select_watermark(conn: sqlite3.Connection,
+                          query: str) -> Optional[int]:
+        result = conn.execute(
+            "SELECT list_time FROM sync_watermarks WHERE query = ?",
+            (query, )).fetchone()
+        return result[0] if result else None
+
+    async def get_watermark(self, query: str) -> Optional[int]:
+        return await self._read(self._select_watermark, query)
+
+    @staticmethod
+    def _upsert_watermark(conn: sqlite3.Connection, query: str,
+                          list_time: int):
+        conn.execute(
+            """
+            INSERT INTO sync_watermarks (query, list_time) VALUES (?, ?)
+            ON CONFLICT (query) DO UPDATE SET
+                list_time = MAX(list_time, excluded.list_time),
+                updated_at = CURRENT_TIMESTAMP
+            """, (query, list_time))
+
+    async def set_watermark(self, query: str, list_time: int):
+        await self._write(self._upsert_watermark, query, list_time)
+
+    # Таблица -> (столбец времени, архивируемые столбцы)
+    RETENTION_TABLES = {
+        "search_history":
+        ("search_date",
+         "id, user_id, query, results_count, search_date, kind"),
+        "ads": ("list_time", "ad_id, brand, title, price, link, search_query, "
+                "list_time, updated_at"),
+    }
+
+    @classmethod
+    def _archive_old_rows(cls, conn: sqlite3.Connection, table: str,
+                          cutoff: Any, limit: int,
+                          archive: Optional[Callable]) -> int:
+        time_column, columns = cls.RETENTION_TABLES[table]
+        cursor = conn.execute(
+            f"""
+            SELECT rowid, {columns} FROM {table} WHERE {time_column} < ?
+            ORDER BY {time_column} LIMIT ?
+            """, (cutoff, limit))
+        names = [column[0] for column in cursor.description[1:]]
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        if archive is not None:
+            archive(table, [dict(zip(names, row[1:])) for row in rows])
+        conn.executemany(f"DELETE FROM {table} WHERE rowid = ?",
+                         [(row[0], ) for row in rows])
+        return len(rows)
+
+    async def archive_old_rows(self,
+                               table: str,
+                               cutoff: Any,
+                               limit: int,
+                               archive: Optional[Callable] = None) -> int:
+        """Удаляет до limit самых старых строк table старше cutoff, сначала
+        передав их archive(table, records). Архив пишется в той же
+        транзакции: если он упал, строки остаются в базе"""
+        return await self._write(self._archive_old_rows, table, cutoff, limit,
+                                 archive)
+
+    @staticmethod
+    def _delete_hourly_rollups(conn: sqlite3.Connection, before: str) -> int:
+        return conn.execute(
+            "DELETE FROM search_stats_hourly WHERE bucket < ?",
+            (before, )).rowcount
+
+    async def prune_hourly_rollups(self, before: datetime) -> int:
+        return await self._write(self._delete_hourly_rollups,
+                                 before.strftime("%Y-%m-%d %H"))
+
+    @staticmethod
+    def _convert_to_incremental_vacuum(conn: sqlite3.Connection) -> bool:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+        return True
+
+    async def enable_incremental_vacuum(self) -> bool:
+        """Переводит базу, созданную без auto_vacuum, на инкрементальный
+        режим (один полный VACUUM); True — если перевод был нужен"""
+        return await self._write(self._convert_to_incremental_vacuum)
+
+    @staticmethod
+    def _incremental_vacuum(conn: sqlite3.Connection, pages: int) -> int:
+        # execute() делает один шаг оператора, а incremental_vacuum
+        # освобождает по странице на шаг: executescript выполняет до конца
+        conn.executescript(f"PRAGMA incremental_vacuum({int(pages)})")
+        return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+    async def incremental_vacuum(self, pages: int) -> int:
+        """Возвращает файлу до pages свободных страниц; результат — сколько
+        свободных страниц осталось"""
+        return await self._write(self._incremental_vacuum, pages)
+
+    @staticmethod
+    def _checkpoint(conn: sqlite3.Connection):
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+    async def checkpoint(self):
+        """Переносит WAL в базу и обрезает файл WAL"""
+        await self._write(self._checkpoint)
+
+    def _storage_stats(self, conn: sqlite3.Connection) -> Dict[str, int]:
+        stats = {
+            name: conn.execute(f"PRAGMA {name}").fetchone()[0]
+            for name in ("page_size", "page_count", "freelist_count",
+                         "auto_vacuum")
+        }
+        for name, path in (("file_size", self.db_name),
+                           ("wal_size", self.db_name + "-wal")):
+            stats[name] = (os.path.getsize(path)
+                           if os.path.exists(path) else 0)
+        return stats
+
+    async def storage_stats(self) -> Dict[str, int]:
+        """Размер файла базы и WAL (байт), число страниц и свободных,
+        режим auto_vacuum (2 — инкрементальный)"""
+        return await self._read(self._storage_stats)
 
 
 db = Database()
 
 
+class SettingsMiddleware(BaseMiddleware):
+    """Загружает настройки пользователя один раз на апдейт и передает их
+    обработчику в аргументе settings (только если обработчик его принимает)"""
+
+    def __init__(self, database: Database):
+        super().__init__()
+        self.db = database
+        self._wants_settings: Dict[Callable, bool] = {}
+
+    def _handler_wants_settings(self) -> bool:
+        handler = current_handler.get(None)
+        if handler is None:
+            return False
+        wants = self._wants_settings.get(handler)
+        if wants is None:
+            wants = "settings" in inspect.signature(handler).parameters
+            self._wants_settings[handler] = wants
+        return wants
+
+    async def _load(self, user: Optional[types.User], data: dict):
+        if user is not None and self._handler_wants_settings():
+            data["settings"] = await self.db.get_user_settings(user.id)
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        await self._load(message.from_user, data)
+
+    async def on_process_callback_query(self, callback_query: CallbackQuery,
+                                        data: dict):
+        await self._load(callback_query.from_user, data)
+
+
+dp.middleware.setup(SettingsMiddleware(db))
+
+
+class SearchHistoryWriter:
+    """Отложенная запись истории поиска (write-behind).
+
+    Обработчики только кладут строку в очередь в памяти и не ждут базу.
+    Фоновая задача записывает очередь одной транзакцией (executemany) раз
+    в interval сек. или как только набралось batch_size строк. stop()
+    дописывает остаток, поэтому при штатной остановке строки не теряются.
+    """
+
+    def __init__(self,
+                 database: Database,
+                 interval: float = HISTORY_FLUSH_INTERVAL,
+                 batch_size: int = HISTORY_FLUSH_ROWS,
+                 max_queued: int = HISTORY_MAX_QUEUED):
+        self.db = database
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_queued = max_queued
+        self._queue: deque = deque()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.flushes = 0
+        self.last_flush_time = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def add(self, user_id: int, query: str, results_count: int, kind: str):
+        """kind — "brand" для кнопки бренда, "custom" для своего запроса"""
+        if len(self._queue) >= self.max_queued:
+            self._queue.popleft()
+            self.dropped += 1
+        # Время поиска фиксируется сейчас, а не при записи (как
+        # CURRENT_TIMESTAMP — UTC)
+        self._queue.append(
+            (user_id, query, results_count,
+             datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"), kind))
+        if len(self._queue) >= self.batch_size:
+            self._full.set()
+
+    async def flush(self) -> int:
+        """Записывает всю очередь; при ошибке строки возвращаются в очередь"""
+        if not self._queue:
+            return 0
+        rows = list(self._queue)
+        self._queue.clear()
+        started = time.perf_counter()
+        try:
+            await self.db.save_search_history(rows)
+        except asyncio.CancelledError:
+            # Запись уже передана потоку-писателю и завершится без нас
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка записи истории поиска: {e}")
+            self._queue.extendleft(reversed(rows))
+            while len(self._queue) > self.max_queued:
+                self._queue.popleft()
+                self.dropped += 1
+            return 0
+        self.last_flush_time = time.perf_counter() - started
+        self.written += len(rows)
+        self.flushes += 1
+        return len(rows)
+
+    async def run(self):
+        while True:
+            # Не wait_for: в Python 3.11 он может проглотить отмену, если
+            # событие сработало одновременно с ней, и stop() зависнет
+            full = asyncio.ensure_future(self._full.wait())
+            try:
+                await asyncio.wait({full}, timeout=self.interval)
+            finally:
+                full.cancel()
+            self._full.clear()
+            await self.flush()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        written = await self.flush()
+        if written:
+            logger.info(f"💾 Дописано {written} строк истории поиска")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": len(self._queue),
+            "written": self.written,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+            "last_flush_time": self.last_flush_time
+        }
+
+
+history_writer = SearchHistoryWriter(db)
+
+
+class RetentionJob:
+    """Фоновое обслуживание базы с низким приоритетом.
+
+    Раз в interval сек. переносит старые строки search_history и ads в
+    помесячные архивы (ARCHIVE_DIR/<таблица>-<ГГГГ-ММ>.ndjson.gz), удаляет
+    старые почасовые сводки, возвращает освободившиеся страницы файлу
+    инкрементальным VACUUM (если база переведена на него, см. prepare) и
+    обрезает WAL. Каждая пачка — короткая
+    транзакция писателя, между пачками пауза, так что запись истории и
+    настроек пользователей не ждет обслуживания.
+
+    Архив дописывается и сбрасывается на диск до удаления строк; при сбое
+    между ними пачка может повториться в архиве (дубли отбрасываются по id
+    или по (ad_id, brand)).
+    """
+
+    START_DELAY = 300
+
+    def __init__(self,
+                 database: Database,
+                 interval: float = RETENTION_INTERVAL,
+                 history_days: int = HISTORY_RETENTION_DAYS,
+                 ads_days: int = ADS_RETENTION_DAYS,
+                 hourly_days: int = ROLLUP_HOURLY_RETENTION_DAYS,
+                 archive_dir: str = ARCHIVE_DIR,
+                 batch_rows: int = RETENTION_BATCH_ROWS,
+                 vacuum_pages: int = VACUUM_STEP_PAGES,
+                 pause: float = RETENTION_PAUSE):
+        self.db = database
+        self.interval = interval
+        self.history_days = history_days
+        self.ads_days = ads_days
+        self.hourly_days = hourly_days
+        self.archive_dir = archive_dir
+        self.batch_rows = batch_rows
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _month(table: str, record: Dict[str, Any]) -> str:
+        if table == "ads":
+            return ts_to_datetime(record["list_time"]).strftime("%Y-%m")
+        return str(record["search_date"])[:7]
+
+    def archive_path(self, table: str, month: str) -> str:
+        return os.path.join(self.archive_dir, f"{table}-{month}.ndjson.gz")
+
+    def _archive(self, table: str, records: List[Dict[str, Any]]):
+        """Дописывает записи в архивы их месяцев (поток-писатель).
+
+        Каждая пачка — отдельный член gzip: файл остается корректным gzip,
+        а дописанное переживает сбой после fsync"""
+        by_month: Dict[str, List[str]] = {}
+        for record in records:
+            by_month.setdefault(self._month(table, record), []).append(
+                json.dumps(record, ensure_ascii=False) + "\n")
+        os.makedirs(self.archive_dir, exist_ok=True)
+        for month, lines in by_month.items():
+            with open(self.archive_path(table, month), "ab") as f:
+                f.write(
+                    gzip.compress("".join(lines).encode("utf-8"),
+                                  compresslevel=6))
+                f.flush()
+                os.fsync(f.fileno())
+
+    @staticmethod
+    def read_archive(path: str) -> Iterator[Dict[str, Any]]:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    async def age_out(self, table: str, cutoff: Any) -> int:
+        """Переносит в архив все строки table старше cutoff"""
+        archive = self._archive if self.archive_dir else None
+        moved = 0
+        while True:
+            count = await self.db.archive_old_rows(table, cutoff,
+                                                   self.batch_rows, archive)
+            moved += count
+            if count < self.batch_rows:
+                return moved
+            await asyncio.sleep(self.pause)
+
+    async def vacuum(self) -> int:
+        """Инкрементальный VACUUM порциями; возвращает число страниц,
+        отданных файлу"""
+        released = 0
+        free_pages = (await self.db.storage_stats())["freelist_count"]
+        while free_pages:
+            left = await self.db.incremental_vacuum(self.vacuum_pages)
+            if left >= free_pages:
+                break
+            released += free_pages - left
+            free_pages = left
+            await asyncio.sleep(self.pause)
+        return released
+
+    async def prepare(self, convert: bool = VACUUM_ON_STARTUP):
+        """Проверяет при запуске, что база умеет отдавать место порциями.
+
+        Старую базу переводит полным VACUUM только при convert: это
+        перезапись всего файла в потоке-писателе, поэтому вызывать до
+        приема апдейтов."""
+        stats = await self.db.storage_stats()
+        if stats["auto_vacuum"] == 2:
+            return
+        size_mb = stats["page_count"] * stats["page_size"] / 1048576
+        if not convert:
+            logger.warning(
+                f"⚠️ База ({size_mb:.1f} МБ) создана без инкрементального "
+                f"VACUUM: старые строки удаляются, но файл не уменьшается. "
+                f"Для перевода запустите бота с VACUUM_ON_STARTUP=1")
+            return
+        logger.info(
+            f"🧹 Перевод базы на инкрементальный VACUUM: полная перезапись "
+            f"{size_mb:.1f} МБ, нужно еще столько же места на диске (плюс "
+            f"WAL того же размера); запись в базу ждет до конца")
+        started = time.monotonic()
+        await self.db.enable_incremental_vacuum()
+        after = await self.db.storage_stats()
+        logger.info(
+            f"🧹 База переведена за {time.monotonic() - started:.1f} сек., "
+            f"размер {size_mb:.1f} → "
+            f"{after['page_count'] * after['page_size'] / 1048576:.1f} МБ")
+
+    async def run_once(self) -> Dict[str, Any]:
+        started = time.monotonic()
+        before = await self.db.storage_stats()
+
+        now = datetime.utcnow()
+        history_cutoff = (now - timedelta(days=self.history_days)).strftime(
+            "%Y-%m-%d %H:%M:%S")
+        ads_cutoff = datetime_to_ts(now - timedelta(days=self.ads_days))
+        report: Dict[str, Any] = {
+            "history_archived": await self.age_out("search_history",
+                                                   history_cutoff),
+            "ads_archived": await self.age_out("ads", ads_cutoff),
+            "hourly_pruned": await self.db.prune_hourly_rollups(
+                now - timedelta(days=self.hourly_days)),
+        }
+        # Без инкрементального режима (база не переведена) свободные
+        # страницы остаются в файле и используются под новые строки
+        report["pages_released"] = (await self.vacuum()
+                                    if before["auto_vacuum"] == 2 else 0)
+        await self.db.checkpoint()
+
+        after = await self.db.storage_stats()
+        report.update({
+            "size_before": before["file_size"] + before["wal_size"],
+            "size_after": after["file_size"] + after["wal_size"],
+            "elapsed": time.monotonic() - started
+        })
+        self.last_report = report
+        logger.info(
+            f"🧹 Обслуживание базы: в архив {report['history_archived']} "
+            f"строк истории и {report['ads_archived']} объявлений, удалено "
+            f"{report['hourly_pruned']} почасовых сводок, размер "
+            f"{report['size_before'] / 1048576:.1f} → "
+            f"{report['size_after'] / 1048576:.1f} МБ за "
+            f"{report['elapsed']:.1f} сек.")
+        return report
+
+    async def run(self):
+        await asyncio.sleep(self.START_DELAY)
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка обслуживания базы: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+retention_job = RetentionJob(db)
+
+
+class SearchCache:
+    """Кэш результатов поиска в памяти процесса (TTL + LRU)"""
+
+    def __init__(self,
+                 ttl: float = SEARCH_CACHE_TTL,
+                 max_entries: int = SEARCH_CACHE_MAX_ENTRIES,
+                 max_ads: int = SEARCH_CACHE_MAX_ADS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_ads = max_ads
+        self._entries: "OrderedDict[Tuple, Tuple[float, List[Ad]]]" = OrderedDict()
+        self._ads_count = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(search_queries: List[str], days_back: int) -> Tuple:
+        """Ключ: нормализованные варианты запроса + глубина поиска"""
+        queries = {" ".join(query.lower().split()) for query in search_queries}
+        return tuple(sorted(queries)), days_back
+
+    def get(self, key: Tuple) -> Optional[List[Ad]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, ads = entry
+        if expires_at < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return ads
+
+    def set(self, key: Tuple, ads: List[Ad]):
+        if self.ttl <= 0 or len(ads) > self.max_ads:
+            return
+        if key in self._entries:
+            self._remove(key)
+
+        self._entries[key] = (time.monotonic() + self.ttl, ads)
+        self._ads_count += len(ads)
+
+        # Вытесняем самые давно использованные записи
+        while (len(self._entries) > self.max_entries
+               or self._ads_count > self.max_ads):
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: Tuple):
+        _, ads = self._entries.pop(key)
+        self._ads_count -= len(ads)
+
+    def clear(self):
+        self._entries.clear()
+        self._ads_count = 0
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "ads": self._ads_count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0
+        }
+
+
+search_cache = SearchCache()
+
+
+class SingleFlight:
+    """Объединяет одинаковые одновременные запросы в один.
+
+    Пока запрос с ключом key выполняется, остальные вызовы с тем же ключом
+    ждут его результат, а не запускают свой.
+    """
+
+    def __init__(self, history_size: int = 100):
+        self._flights: Dict[Tuple, asyncio.Task] = {}
+        self._callers: Dict[Tuple, int] = {}
+        # (ключ, сколько вызовов обслужил запрос) для последних запросов
+        self.recent_flights: deque = deque(maxlen=history_size)
+        self.flights = 0
+        self.coalesced = 0
+
+    async def do(self, key: Tuple, factory: Callable[[], Awaitable[Any]]):
+        task = self._flights.get(key)
+        if task is not None:
+            self._callers[key] += 1
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(factory())
+            self._flights[key] = task
+            self._callers[key] = 1
+            self.flights += 1
+            task.add_done_callback(lambda _: self._finish(key))
+
+        # shield: отмена одного из ожидающих не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def _finish(self, key: Tuple):
+        self._flights.pop(key, None)
+        callers = self._callers.pop(key, 1)
+        self.recent_flights.append((key, callers))
+        if callers > 1:
+            logger.info(f"🔗 Запрос {key} обслужил {callers} вызовов")
+
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight": len(self._flights),
+            "flights": self.flights,
+            "coalesced": self.coalesced,
+            "recent_flights": list(self.recent_flights)
+        }
+
+
+search_flights = SingleFlight()
+
+
+def ad_date_key(ad: Ad) -> int:
+    return ad.ts
+
+
+class AdCollection:
+    """Упорядоченная коллекция объявлений с индексом по id.
+
+    Добавление и проверка дубликата — O(1); при повторе id остается
+    объявление, добавленное первым.
+    """
+
+    __slots__ = ("_ads", )
+
+    def __init__(self, ads: Iterable[Ad] = ()):
+        self._ads: Dict[str, Ad] = {}
+        self.extend(ads)
+
+    def add(self, ad: Ad) -> bool:
+        """Добавляет объявление; False — если такой id уже есть"""
+        if ad.id in self._ads:
+            return False
+        self._ads[ad.id] = ad
+        return True
+
+    def extend(self, ads: Iterable[Ad]) -> int:
+        return sum(self.add(ad) for ad in ads)
+
+    def merge(self, other: "AdCollection") -> int:
+        return self.extend(other)
+
+    def get(self, ad_id: str) -> Optional[Ad]:
+        return self._ads.get(ad_id)
+
+    def __contains__(self, ad_id: str) -> bool:
+        return ad_id in self._ads
+
+    def __len__(self) -> int:
+        return len(self._ads)
+
+    def __iter__(self) -> Iterator[Ad]:
+        return iter(self._ads.values())
+
+    def to_list(self) -> List[Ad]:
+        """Объявления в порядке добавления"""
+        return list(self._ads.values())
+
+    def sorted_by_date(self) -> List[Ad]:
+        """Объявления по дате, новые сверху. Пачки из API уже отсортированы,
+        поэтому сортировка сливает готовые серии почти за линейное время"""
+        return sorted(self._ads.values(), key=ad_date_key, reverse=True)
+
+
+class TokenBucket:
+    """Ограничитель частоты (token bucket): rate токенов в секунду,
+    не больше capacity накопленных токенов"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Ждет, пока не освободится токен"""
+        if self.rate <= 0:
+            return
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+kufar_rate_limiter = TokenBucket(KUFAR_REQUESTS_PER_SECOND,
+                                 KUFAR_REQUESTS_BURST)
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open -> half-open (одна проба) -> closed"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self,
+                 name: str,
+                 failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 reset_timeout: float = BREAKER_RESET_TIMEOUT,
+                 max_reset_timeout: float = BREAKER_MAX_RESET_TIMEOUT):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.failures = 0
+        self._state = self.CLOSED
+        self._opened_at = 0.0
+        self._open_for = reset_timeout
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if (self._state == self.OPEN
+                and time.monotonic() - self._opened_at >= self._open_for):
+            self._state = self.HALF_OPEN
+        return self._state
+
+    def allow_request(self) -> bool:
+        """Можно ли отправить запрос. В half-open пропускает одну пробу"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def release_probe(self):
+        """Проба отменена или ничего не показала — можно пробовать снова"""
+        self._probe_in_flight = False
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info(f"✅ Зеркало {self.name} снова доступно")
+        self._state = self.CLOSED
+        self.failures = 0
+        self._open_for = self.reset_timeout
+        self._probe_in_flight = False
+
+    def record_failure(self, retry_after: Optional[float] = None):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self._open(min(self.max_reset_timeout, self._open_for * 2))
+        elif retry_after:
+            self._open(min(self.max_reset_timeout, retry_after))
+        elif self.failures >= self.failure_threshold:
+            self._open(self.reset_timeout)
+
+    def _open(self, duration: float):
+        self._state = self.OPEN
+        self._opened_at = time.monotonic()
+        self._open_for = duration
+        logger.warning(
+            f"⛔ Зеркало {self.name} отключено на {duration:.0f} сек.")
+
+
+class Mirror:
+    """Состояние зеркала API: свой ограничитель частоты, предохранитель и
+    скользящая статистика задержек и ошибок"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.base_rate = MIRROR_REQUESTS_PER_SECOND
+        self.bucket = TokenBucket(self.base_rate, MIRROR_REQUESTS_BURST)
+        self.breaker = CircuitBreaker(url)
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+
+    def _observe(self, latency: Optional[float], failed: bool):
+        self.requests += 1
+        self.failures += int(failed)
+        self.error_rate += MIRROR_EWMA_ALPHA * (float(failed) -
+                                                self.error_rate)
+        if latency is not None:
+            if self.latency_ewma is None:
+                self.latency_ewma = latency
+            else:
+                self.latency_ewma += MIRROR_EWMA_ALPHA * (latency -
+                                                          self.latency_ewma)
+
+    def record_success(self, latency: Optional[float] = None):
+        self._observe(latency, False)
+        self.breaker.record_success()
+        # После замедления частота возвращается постепенно
+        self.bucket.rate = min(self.base_rate,
+                               self.bucket.rate + self.base_rate * 0.1)
+
+    def record_failure(self,
+                       retry_after: Optional[float] = None,
+                       latency: Optional[float] = None):
+        self._observe(latency, True)
+        self.breaker.record_failure(retry_after)
+        self.bucket.rate = max(MIRROR_MIN_RATE, self.bucket.rate / 2)
+
+    @property
+    def score(self) -> float:
+        """Ожидаемая цена запроса, сек.: задержка плюс штраф за ошибки
+        (неудачная попытка стоит до полного таймаута)"""
+        if self.breaker.state == CircuitBreaker.OPEN:
+            return float("inf")
+        # Пока замеров нет, считаем зеркало таким же медленным, как порог
+        # хеджирования (ориентир p95)
+        latency = (self.latency_ewma if self.latency_ewma is not None else
+                   KUFAR_HEDGE_DELAY)
+        return latency + self.error_rate * KUFAR_REQUEST_TIMEOUT
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "state": self.breaker.state,
+            "latency_ewma": self.latency_ewma,
+            "error_rate": self.error_rate,
+            "requests": self.requests,
+            "failures": self.failures,
+            "rate": self.bucket.rate,
+            "score": self.score
+        }
+
+
+MIRRORS: Dict[str, Mirror] = {}
+_leading_mirror: Optional[str] = None
+
+
+def kufar_mirror_urls() -> List[str]:
+    return [KUFAR_API_URL] + ALT_KUFAR_API_URLS
+
+
+def rank_mirrors(urls: List[str]) -> List[str]:
+    """Зеркала по возрастанию ожидаемой цены запроса; при равенстве —
+    в порядке из настроек"""
+    global _leading_mirror
+    ranked = sorted(enumerate(urls),
+                    key=lambda item: (get_mirror(item[1]).score, item[0]))
+    ranked_urls = [url for _, url in ranked]
+    if ranked_urls and ranked_urls[0] != _leading_mirror:
+        if _leading_mirror is not None:
+            logger.info(f"🏁 Основное зеркало теперь {ranked_urls[0]}")
+        _leading_mirror = ranked_urls[0]
+    return ranked_urls
+
+
+def mirror_stats() -> List[Dict[str, Any]]:
+    """Текущий рейтинг зеркал со статистикой (первое обслуживает трафик)"""
+    return [get_mirror(url).stats() for url in rank_mirrors(kufar_mirror_urls())]
+
+
+def get_mirror(url: str) -> Mirror:
+    mirror = MIRRORS.get(url)
+    if mirror is None:
+        mirror = MIRRORS[url] = Mirror(url)
+    return mirror
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except ValueError:
+        return None
+
+
+def decode_json(body: bytes) -> Any:
+    """Разбирает JSON через orjson, если он установлен, иначе через json"""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+# Общая сессия для всех запросов к Kufar. Создается при старте диспетчера и
+# закрывается при остановке, поэтому TCP/TLS-соединения и DNS переиспользуются
+# между поисками
+kufar_session: Optional[aiohttp.ClientSession] = None
+
+
+def create_kufar_session() -> aiohttp.ClientSession:
+    """Создает сессию aiohttp с настроенным пулом соединений"""
+    connector = aiohttp.TCPConnector(
+        limit_per_host=KUFAR_CONNECTIONS_PER_HOST,
+        keepalive_timeout=KUFAR_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=KUFAR_DNS_CACHE_TTL)
+    return aiohttp.ClientSession(connector=connector)
+
+
+class KufarCassette:
+    """Запись и воспроизведение ответов Kufar API.
+
+    Каждая запись — строка JSON в gzip-файле: адрес, параметры, статус,
+    Retry-After, тело ответа и задержка (или текст ошибки соединения).
+    При воспроизведении записи с одинаковыми параметрами отдаются по кругу
+    в исходном порядке, после исходной задержки.
+    """
+
+    def __init__(self, path: str, mode: str):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"Неизвестный режим кассеты: {mode}")
+        self.path = path
+        self.mode = mode
+        self._file = None
+        self._records: Dict[str, deque] = {}
+        if mode == "record":
+            self._file = gzip.open(path, "at", encoding="utf-8")
+        else:
+            for record in self.read_records(path):
+                self._records.setdefault(self._key(record["params"]),
+                                         deque()).append(record)
+            total = sum(len(records) for records in self._records.values())
+            logger.info(
+                f"📼 Кассета {path}: {total} ответов для воспроизведения")
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == "replay"
+
+    @staticmethod
+    def _key(params: Dict[str, Any]) -> str:
+        return json.dumps({key: str(value) for key, value in params.items()},
+                          sort_keys=True,
+                          ensure_ascii=False)
+
+    @staticmethod
+    def read_records(path: str) -> Iterator[Dict[str, Any]]:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    def record(self,
+               url: str,
+               params: Dict[str, Any],
+               status: Optional[int],
+               body: bytes,
+               retry_after: Optional[str],
+               latency: float,
+               error: Optional[str] = None):
+        self._file.write(json.dumps({
+            "url": url,
+            "params": params,
+            "status": status,
+            "retry_after": retry_after,
+            "latency": round(latency, 4),
+            "error": error,
+            "body": body.decode("utf-8", "replace")
+        }, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    async def replay(self, params: Dict[str, Any]
+                     ) -> Tuple[int, bytes, Optional[str]]:
+        records = self._records.get(self._key(params))
+        if not records:
+            logger.warning(f"📼 В кассете нет ответа для {params}")
+            return 404, b"", None
+        record = records[0]
+        records.rotate(-1)
+
+        await asyncio.sleep(record["latency"])
+        if record["error"] is not None:
+            raise aiohttp.ClientError(record["error"])
+        return (record["status"], record["body"].encode("utf-8"),
+                record["retry_after"])
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+kufar_cassette = (KufarCassette(KUFAR_CASSETTE_PATH, KUFAR_CASSETTE_MODE)
+                  if KUFAR_CASSETTE_MODE else None)
+
+
+class KufarFetchError(Exception):
+    """Страница выдачи Kufar не получена ни с одного зеркала: результат
+    обхода неполный"""
+
+
 class KufarAPI:
 
-    def __init__(self):
-        self.session: Optional[aiohttp.ClientSession] = None
+    # Поля товара, которые читают _parse_ads и _oldest_date (с запасными
+    # именами для других форматов ответа)
+    PRODUCT_FIELDS = ("subject", "title", "name", "ad_id", "id", "item_id",
+                      "list_time", "price_byn", "price", "ad_link", "url")
+
+    def __init__(self,
+                 max_concurrency: int = KUFAR_MAX_CONCURRENCY,
+                 hedge_delay: float = KUFAR_HEDGE_DELAY,
+                 max_hedges: int = KUFAR_MAX_HEDGES,
+                 session: Optional[aiohttp.ClientSession] = None):
+        self.session: Optional[aiohttp.ClientSession] = session
+        self.max_concurrency = max_concurrency
+        self.hedge_delay = hedge_delay
+        self.max_hedges = max_hedges
+        self._owns_session = False
+
+    def _ensure_session(self):
+        """Берет общую сессию, а если ее нет (бот не запущен) — создает свою"""
+        if self.session and not self.session.closed:
+            return
+        if kufar_session and not kufar_session.closed:
+            self.session = kufar_session
+        else:
+            self.session = create_kufar_session()
+            self._owns_session = True
 
     async def __aenter__(self):
-        self.session = aiohttp.ClientSession()
+        self._ensure_session()
         return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        if self.session:
+        # Общую сессию закрывает только on_shutdown
+        if self.session and self._owns_session:
             await self.session.close()
+            self._owns_session = False
 
-    async def search_ads(self,
-                         search_queries: List[str],
-                         days_back: int = 10) -> List[Dict[str, Any]]:
-        if not self.session:
-            self.session = aiohttp.ClientSession()
-
-        headers = {
-            "User-Agent":
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Accept": "application/json",
-            "Origin": "https://kufar.by",
-            "Referer": "https://kufar.by/",
+    async def _request(self, url: str,
+                       params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Один запрос к зеркалу API. None — если зеркало не ответило"""
+        mirror = get_mirror(url)
+        started = None
+        try:
+            await kufar_rate_limiter.acquire()
+            await mirror.bucket.acquire()
+            logger.info(
+                f"📡 Запрос к API: {url} для запроса '{params.get('query')}'")
+
+            started = time.monotonic()
+            status, body, retry_after = await self._get(url, params)
+            if status == 200:
+                data = self._decode_response(body)
+                mirror.record_success(time.monotonic() - started)
+                return data
+
+            logger.warning(f"❌ {url} ответил статусом {status}")
+            if status == 429:
+                mirror.record_failure(parse_retry_after(retry_after),
+                                      time.monotonic() - started)
+            elif status >= 500:
+                mirror.record_failure(latency=time.monotonic() - started)
+            else:
+                mirror.breaker.release_probe()
+        except asyncio.CancelledError:
+            mirror.breaker.release_probe()
+            raise
+        except Exception as e:
+            logger.warning(f"❌ Ошибка при запросе к {url}: {e}")
+            mirror.record_failure(
+                latency=time.monotonic() - started if started else None)
+        return None
+
+    async def _get(self, url: str, params: Dict[str, Any]
+                   ) -> Tuple[int, bytes, Optional[str]]:
+        """Сырой ответ зеркала: (статус, тело, Retry-After).
+
+        В режиме кассеты ответ пишется в kufar_cassette или берется из нее.
+        """
+        if kufar_cassette is not None and kufar_cassette.replaying:
+            return await kufar_cassette.replay(params)
+
+        started = time.monotonic()
+        try:
+            async with self.session.get(url,
+                                        params=params,
+                                        headers=KUFAR_HEADERS,
+                                        timeout=KUFAR_REQUEST_TIMEOUT) as response:
+                result = (response.status, await response.read(),
+                          response.headers.get("Retry-After"))
+        except Exception as e:
+            if kufar_cassette is not None:
+                kufar_cassette.record(url, params, None, b"", None,
+                                      time.monotonic() - started,
+                                      repr(e))
+            raise
+        if kufar_cassette is not None:
+            kufar_cassette.record(url, params, *result,
+                                  time.monotonic() - started)
+        return result
+
+    async def _fetch_from_mirrors(
+            self, params: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Запрашивает зеркала API с хеджированием.
+
+        Первое зеркало получает запрос сразу. Если оно не ответило за
+        hedge_delay, тот же запрос уходит на следующее зеркало (не больше
+        max_hedges раз). Ошибка зеркала сразу передает запрос следующему.
+        Побеждает первый успешный ответ, остальные запросы отменяются.
+        Зеркала перебираются по живому рейтингу (rank_mirrors), зеркала с
+        разомкнутым предохранителем пропускаются сразу.
+        """
+        urls = rank_mirrors(kufar_mirror_urls())
+        hedging = bool(self.hedge_delay) and self.hedge_delay > 0
+        pending = set()
+        next_idx = 0
+        hedges = 0
+
+        def launch() -> bool:
+            nonlocal next_idx
+            while next_idx < len(urls):
+                mirror = get_mirror(urls[next_idx])
+                next_idx += 1
+                if mirror.breaker.allow_request():
+                    pending.add(
+                        asyncio.ensure_future(self._request(mirror.url,
+                                                            params)))
+                    return True
+                logger.info(f"⛔ Пропускаем отключенное зеркало {mirror.url}")
+            return False
+
+        if not launch():
+            logger.warning("❌ Все зеркала Kufar API временно отключены")
+            return None
+        try:
+            while pending:
+                can_hedge = (hedging and hedges < self.max_hedges
+                             and next_idx < len(urls))
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    hedges += 1
+                    logger.info(f"⏱️ Нет ответа за {self.hedge_delay} сек., "
+                                f"хеджируем на следующее зеркало")
+                    launch()
+                    continue
+
+                for task in done:
+                    pending.discard(task)
+                    data = task.result()
+                    if data is not None:
+                        return data
+                    launch()
+            return None
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def iter_query_pages(
+            self, search_query: str, cutoff_date: datetime,
+            semaphore: asyncio.Semaphore) -> AsyncIterator[List[Ad]]:
+        """Постранично отдает объявления одного варианта запроса.
+
+        Идет по курсору пагинации API и останавливается на первой странице,
+        которая заходит дальше cutoff_date (выдача отсортирована по дате).
+        """
+        params = self._query_params(search_query)
+        async for ads, _ in self._iter_pages(params, search_query,
+                                             cutoff_date, semaphore,
+                                             KUFAR_MAX_PAGES):
+            if ads:
+                yield ads
+
+    @staticmethod
+    def _query_params(search_query: str) -> Dict[str, Any]:
+        return {
+            "query": search_query,
+            "size": KUFAR_PAGE_SIZE,
+            "lang": "ru",
+            "sort": "lst.d"
         }
 
+    async def iter_newest_pages(
+            self,
+            cutoff_date: datetime,
+            category: Optional[str] = None,
+            max_pages: int = FIREHOSE_MAX_PAGES
+    ) -> AsyncIterator[Tuple[List[Ad], Optional[datetime]]]:
+        """Лента новых объявлений без поискового запроса (режим firehose).
+
+        Отдает для каждой страницы объявления, в заголовках которых нашелся
+        хоть один бренд, и самую старую дату страницы, чтобы вызывающий
+        знал, докуда дошла лента.
+        """
+        self._ensure_session()
+
+        params = {"size": KUFAR_PAGE_SIZE, "lang": "ru", "sort": "lst.d"}
+        if category:
+            params["cat"] = category
+        # Страницы ленты идут строго по курсору — параллелить нечего
+        semaphore = asyncio.Semaphore(1)
+        try:
+            async for page in self._iter_pages(params, None, cutoff_date,
+                                               semaphore, max_pages):
+                yield page
+        except KufarFetchError as e:
+            # Недогруженную ленту видно по дате последней страницы:
+            # harvest_stream начнет покрытие заново
+            logger.warning(f"⚠️ Лента оборвалась: {e}")
+
+    async def _iter_pages(
+            self, params: Dict[str, Any], search_query: Optional[str],
+            cutoff_date: datetime, semaphore: asyncio.Semaphore,
+            max_pages: int
+    ) -> AsyncIterator[Tuple[List[Ad], Optional[datetime]]]:
+        """Общий обход выдачи по курсору: (объявления новее cutoff_date,
+        самая старая дата страницы) для каждой страницы"""
+        cutoff_ts = datetime_to_ts(cutoff_date)
+
+        for _ in range(max_pages):
+            async with semaphore:
+                data = await self._fetch_from_mirrors(params)
+            if data is None:
+                raise KufarFetchError(
+                    f"страница выдачи '{search_query or 'лента'}' не получена")
+
+            ads = [
+                ad for ad in self._parse_ads(data, search_query)
+                if ad.ts and ad.ts >= cutoff_ts
+            ]
+            oldest_date = self._oldest_date(data)
+            yield ads, oldest_date
+
+            cursor = self._next_cursor(data)
+            if not cursor or oldest_date is None or oldest_date < cutoff_date:
+                return
+            params = dict(params, cursor=cursor)
+
+    async def fetch_since(self, search_query: str,
+                          since: datetime) -> Tuple[List[Ad], datetime]:
+        """Объявления одного варианта запроса новее since и дата, до которой
+        дошел обход: since, если выдача пройдена до конца, иначе самая
+        старая дата последней страницы (уперлись в KUFAR_MAX_PAGES)"""
+        self._ensure_session()
+
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
         all_ads = []
+        pages = 0
+        reached: Optional[datetime] = None
+        async for ads, oldest_date in self._iter_pages(
+                self._query_params(search_query), search_query, since,
+                semaphore, KUFAR_MAX_PAGES):
+            pages += 1
+            reached = oldest_date
+            all_ads.extend(ads)
+        if pages == KUFAR_MAX_PAGES and reached is not None and reached >= since:
+            return all_ads, reached
+        return all_ads, since
+
+    async def stream_ads(
+            self,
+            search_queries: List[str],
+            days_back: int = 10) -> AsyncIterator[List[Ad]]:
+        """Отдает объявления пачками по мере загрузки страниц.
+
+        Все варианты запроса обходятся параллельно (не больше max_concurrency
+        запросов одновременно), пачки приходят в порядке получения. Если
+        какой-то вариант не догружен, после всех пачек поднимается
+        KufarFetchError.
+        """
+        self._ensure_session()
+
         cutoff_date = datetime.now() - timedelta(days=days_back)
+        semaphore = asyncio.Semaphore(max(1, self.max_concurrency))
+        queue: asyncio.Queue = asyncio.Queue()
+        failed: List[str] = []
 
-        for search_query in search_queries:
-            for url in [KUFAR_API_URL] + ALT_KUFAR_API_URLS:
-                try:
-                    params = {
-                        "query": search_query,
-                        "size": 100,
-                        "lang": "ru",
-                        "sort": "lst.d"
-                    }
-                    logger.info(
-                        f"📡 Запрос к API: {url} для запроса '{search_query}'")
-
-                    async with self.session.get(url,
-                                                params=params,
-                                                headers=headers,
-                                                timeout=10) as response:
-                        if response.status == 200:
-                            data = await response.json()
-                            ads = self._parse_ads(data, search_query)
-
-                            # Фильтруем по дате
-                            for ad in ads:
-                                if "date" in ad and ad["date"] >= cutoff_date:
-                                    if ad not in all_ads:
-                                        all_ads.append(ad)
-                            break
-                except Exception as e:
-                    logger.warning(f"❌ Ошибка при запросе к {url}: {e}")
+        async def produce(search_query: str):
+            try:
+                async for ads in self.iter_query_pages(search_query,
+                                                       cutoff_date, semaphore):
+                    queue.put_nowait(ads)
+            except Exception as e:
+                logger.error(f"❌ Ошибка при поиске '{search_query}': {e}")
+                failed.append(search_query)
+            finally:
+                queue.put_nowait(None)
+
+        tasks = [
+            asyncio.create_task(produce(search_query))
+            for search_query in search_queries
+        ]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                ads = await queue.get()
+                if ads is None:
+                    remaining -= 1
+                    continue
+                yield ads
+        finally:
+            for task in tasks:
+                task.cancel()
+        if failed:
+            raise KufarFetchError(
+                f"не догружены варианты: {', '.join(failed)}")
+
+    async def search_ads(
+            self,
+            search_queries: List[str],
+            days_back: int = 10,
+            use_cache: bool = True,
+            on_first_page: Optional[Callable[[List[Ad]], None]] = None
+    ) -> List[Ad]:
+        """Объявления по всем вариантам запроса, новые сверху.
+
+        on_first_page получает первые ITEMS_PER_PAGE объявлений, как только
+        они окончательны (см. _collect_ads), чтобы показать их до конца
+        загрузки. Не вызывается, если ответ взят из кэша или из чужого
+        такого же поиска.
+
+        Неполный результат (часть страниц не получена) возвращается, но не
+        кэшируется; если не получено ничего, поднимается KufarFetchError.
+        """
+        cache_key = SearchCache.make_key(search_queries, days_back)
+        if use_cache:
+            cached = search_cache.get(cache_key)
+            if cached is not None:
+                logger.info(
+                    f"⚡ Результат из кэша для {list(cache_key[0])}: "
+                    f"{len(cached)} объявлений")
+                return list(cached)
+
+        # Одинаковые одновременные поиски (много пользователей нажали одну
+        # кнопку) ждут один общий запрос к Kufar
+        all_ads, complete = await search_flights.do(
+            cache_key, lambda: self._collect_ads(search_queries, days_back,
+                                                 on_first_page))
+        if complete:
+            search_cache.set(cache_key, all_ads)
+        elif not all_ads:
+            raise KufarFetchError(
+                f"Kufar недоступен для {list(cache_key[0])}")
+        return list(all_ads)
+
+    async def _collect_ads(
+            self,
+            search_queries: List[str],
+            days_back: int,
+            on_first_page: Optional[Callable[[List[Ad]], None]] = None
+    ) -> Tuple[List[Ad], bool]:
+        """(объявления, новые сверху; все ли страницы получены)"""
+        collection = AdCollection()
+        complete = True
+        # Страницы одного варианта идут от новых к старым, поэтому первые
+        # ITEMS_PER_PAGE объявлений уже не изменятся. У нескольких вариантов
+        # следующая пачка может оказаться новее — ждем весь результат
+        first_page = on_first_page if len(search_queries) == 1 else None
+
+        try:
+            async for ads in self.stream_ads(search_queries, days_back):
+                collection.extend(ads)
+                if (first_page is not None
+                        and len(collection) >= ITEMS_PER_PAGE):
+                    first_page(collection.sorted_by_date()[:ITEMS_PER_PAGE])
+                    first_page = None
+        except KufarFetchError as e:
+            complete = False
+            logger.warning(f"⚠️ Неполный результат не кэшируется: {e}")
 
         # Сортируем по дате (новые сверху)
-        all_ads.sort(key=lambda x: x.get("date", datetime.min), reverse=True)
+        all_ads = collection.sorted_by_date()
         logger.info(f"✅ Всего получено {len(all_ads)} уникальных объявлений")
-        return all_ads
+        return all_ads, complete
+
+    async def search_all_ads_recent(self) -> List[Ad]:
+        """Объявления всех брендов за последние сутки.
 
-    async def search_all_ads_recent(self) -> List[Dict[str, Any]]:
-        all_results = []
-        cutoff_date = datetime.now() - timedelta(days=LAST_24H_HOURS)
+        Бренды сканируются параллельно (не больше RECENT_SCAN_CONCURRENCY
+        одновременно), частоту запросов ограничивает kufar_rate_limiter.
+        """
+        cutoff_ts = datetime_to_ts(datetime.now() -
+                                   timedelta(days=LAST_24H_HOURS))
+        semaphore = asyncio.Semaphore(max(1, RECENT_SCAN_CONCURRENCY))
 
-        for query_key, search_queries in SEARCH_QUERIES.items():
+        async def scan(query_key: str,
+                       search_queries: List[str]) -> List[Ad]:
             try:
-                ads = await self.search_ads(search_queries,
-                                            days_back=LAST_24H_HOURS)
-                for ad in ads:
-                    if "date" in ad and ad["date"] >= cutoff_date:
-                        ad["search_query_display"] = BUTTON_NAMES.get(
-                            query_key, query_key)
-                        if ad not in all_results:
-                            all_results.append(ad)
+                async with semaphore:
+                    return await self.search_ads(search_queries,
+                                                 days_back=LAST_24H_HOURS)
             except Exception as e:
                 logger.error(f"❌ Ошибка при поиске '{query_key}': {e}")
-
-        all_results.sort(key=lambda x: x.get("date", datetime.min),
-                         reverse=True)
-        return all_results
+                return []
+
+        results = await asyncio.gather(
+            *(scan(query_key, search_queries)
+              for query_key, search_queries in SEARCH_QUERIES.items()))
+
+        # Объединяем по id: объявление подписывается первым по порядку
+        # брендом, найденным в его заголовке
+        all_results = AdCollection()
+        for query_key, ads in zip(SEARCH_QUERIES, results):
+            for ad in ads:
+                if ad.ts >= cutoff_ts and ad.id not in all_results:
+                    # Копия, чтобы не менять объявления, лежащие в кэше
+                    all_results.add(
+                        ad.with_brand(ad.brands[0] if ad.brands else query_key))
+
+        return all_results.sorted_by_date()
+
+    @staticmethod
+    def _products(data: Dict[str, Any]) -> List[Any]:
+        return data.get("ads", []) or data.get("products", [])
+
+    @classmethod
+    def _decode_response(cls, body: bytes) -> Dict[str, Any]:
+        """Разбирает ответ и оставляет только поля, которые читает парсер.
+
+        Параметры, картинки и данные продавца отбрасываются сразу, поэтому
+        ответ не держит их в памяти, пока идут хеджирование и пагинация.
+        """
+        data = decode_json(body)
+        if not isinstance(data, dict):
+            return {}
+        fields = cls.PRODUCT_FIELDS
+        products = [{field: product[field] for field in fields
+                     if field in product}
+                    for product in cls._products(data)
+                    if isinstance(product, dict)]
+        pagination = data.get("pagination") or {}
+        pages = [{"label": page.get("label"), "token": page.get("token")}
+                 for page in pagination.get("pages", []) or []
+                 if isinstance(page, dict)]
+        return {"ads": products, "pagination": {"pages": pages}}
+
+    @staticmethod
+    def _parse_list_time(list_time: Any) -> Optional[datetime]:
+        if isinstance(list_time, str):
+            try:
+                return datetime.fromisoformat(list_time.replace('Z', ''))
+            except Exception:
+                pass
+        return None
+
+    def _oldest_date(self, data: Dict[str, Any]) -> Optional[datetime]:
+        """Самая старая дата на странице (по всем товарам, до фильтрации)"""
+        dates = [
+            self._parse_list_time(product.get("list_time"))
+            for product in self._products(data) if isinstance(product, dict)
+        ]
+        dates = [date for date in dates if date]
+        return min(dates) if dates else None
+
+    @staticmethod
+    def _next_cursor(data: Dict[str, Any]) -> Optional[str]:
+        """Курсор следующей страницы из блока pagination ответа"""
+        pagination = data.get("pagination") or {}
+        for page in pagination.get("pages", []) or []:
+            if isinstance(page, dict) and page.get("label") == "next":
+                return page.get("token")
+        return None
 
     def _parse_ads(self, data: Dict[str, Any],
-                   search_query: str) -> List[Dict[str, Any]]:
-        ads = []
+                   search_query: Optional[str]) -> List[Ad]:
+        """Объявления ответа, в заголовке которых есть search_query.
+
+        Каждый заголовок приводится к нижнему регистру один раз и сразу
+        классифицируется brand_matcher по всем брендам; для запросов вне
+        SEARCH_QUERIES (свой поиск) остается обычная проверка подстроки.
+        Без search_query (лента firehose) остаются объявления любого бренда.
+        """
+        ads = AdCollection()
+        query_lower = search_query.lower() if search_query else None
+        is_variant = bool(query_lower) and brand_matcher.is_variant(query_lower)
         try:
-            products = data.get("ads", []) or data.get("products", [])
+            products = self._products(data)
 
             for product in products:
                 if not isinstance(product, dict):
@@ -1036,18 +3183,18 @@ class KufarAPI:
                     continue
 
                 # Проверяем наличие поискового запроса ТОЛЬКО в заголовке
-                if search_query.lower() not in title.lower():
+                title_lower = title.lower()
+                variants = brand_matcher.match(title_lower)
+                if query_lower is None:
+                    if not variants:
+                        continue
+                elif is_variant:
+                    if query_lower not in variants:
+                        continue
+                elif query_lower not in title_lower:
                     continue
 
-                ad_date = None
-                if "list_time" in product:
-                    list_time = product["list_time"]
-                    if isinstance(list_time, str):
-                        try:
-                            list_time = list_time.replace('Z', '')
-                            ad_date = datetime.fromisoformat(list_time)
-                        except Exception:
-                            pass
+                ad_date = self._parse_list_time(product.get("list_time"))
 
                 price = 0
                 if "price_byn" in product:
@@ -1065,25 +3212,375 @@ class KufarAPI:
                 if not link and ad_id:
                     link = f"https://kufar.by/item/{ad_id}"
 
-                ad_data = {
-                    "id": ad_id,
-                    "title": title,
-                    "price": float(price) if price else 0,
-                    "link": link,
-                    "search_query": search_query
-                }
-
-                if ad_date:
-                    ad_data["date"] = ad_date
+                ad_data = Ad(ad_id, title,
+                             float(price) if price else 0, link, search_query,
+                             datetime_to_ts(ad_date) if ad_date else 0,
+                             brands=brand_matcher.brands(variants))
 
                 # Проверяем уникальность по ID
-                if not any(a["id"] == ad_id for a in ads):
-                    ads.append(ad_data)
+                ads.add(ad_data)
 
         except Exception as e:
             logger.error(f"❌ Ошибка парсинга: {e}")
 
-        return ads
+        return ads.to_list()
+
+
+class AdStore:
+    """Локальное хранилище объявлений поверх таблицы ads.
+
+    Наполняется AdHarvester; хранит, когда каждый бренд собирался в
+    последний раз, чтобы обработчики знали, можно ли отвечать из базы.
+    """
+
+    def __init__(self,
+                 database: Database,
+                 max_staleness: float = HARVEST_INTERVAL * 2,
+                 retention_days: int = ADS_RETENTION_DAYS):
+        self.db = database
+        self.max_staleness = max_staleness
+        self.retention_days = retention_days
+        # бренд -> время последнего успешного сбора (time.monotonic)
+        self._synced_at: Dict[str, float] = {}
+        # бренд -> дата, начиная с которой в базе собраны все объявления
+        self._covered_since: Dict[str, datetime] = {}
+
+    async def upsert(self, brand: Optional[str], ads: List[Ad]) -> int:
+        """Сохраняет объявления под brand и под всеми остальными брендами,
+        найденными в их заголовках (без brand — только под найденными)"""
+        by_brand: Dict[str, List[Ad]] = {brand: list(ads)} if brand else {}
+        for ad in ads:
+            for other in ad.brands:
+                if other != brand:
+                    by_brand.setdefault(other, []).append(ad)
+        written = 0
+        for key, batch in by_brand.items():
+            written += await self.db.upsert_ads(key, batch)
+        return written
+
+    def mark_synced(self, brand: str, covered_since: datetime):
+        self._synced_at[brand] = time.monotonic()
+        self._covered_since[brand] = covered_since
+
+    def is_fresh(self, brand: str, days_back: int) -> bool:
+        """Можно ли ответить на поиск по бренду из хранилища"""
+        synced_at = self._synced_at.get(brand)
+        if (synced_at is None
+                or time.monotonic() - synced_at > self.max_staleness):
+            return False
+        # Объявления старше retention_days уходят в архив, поэтому покрытие
+        # не может начинаться раньше
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        retained_since = datetime.now() - timedelta(days=self.retention_days)
+        return cutoff_date >= max(self._covered_since[brand], retained_since)
+
+    def is_fresh_all(self, days_back: int) -> bool:
+        return all(self.is_fresh(brand, days_back) for brand in SEARCH_QUERIES)
+
+    async def get_brand_ads(self, brand: str,
+                            days_back: int) -> List[Ad]:
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        return await self.db.get_ads(brand, cutoff_date)
+
+    def covering_brand(self, text: str, days_back: int) -> Optional[str]:
+        """Бренд, чьи собранные объявления гарантированно содержат все
+        результаты поиска text.
+
+        Если запрос содержит вариант запроса бренда целыми словами, то любой
+        подходящий заголовок содержит эти слова, и поиск Kufar по варианту
+        его уже вернул. Вариант внутри слова ("hikikomori" в
+        "hikikomorishop", "нефор" в "неформал") этого не гарантирует: такие
+        заголовки поиск по варианту не находит, нужен живой поиск.
+        """
+        needle = " ".join(text.lower().split())
+        for brand, search_queries in SEARCH_QUERIES.items():
+            if any(
+                    re.search(rf"(?<!\w){re.escape(query.lower())}(?!\w)",
+                              needle) for query in search_queries):
+                if self.is_fresh(brand, days_back):
+                    return brand
+        return None
+
+    async def search_custom(self, text: str,
+                            days_back: int) -> Optional[List[Ad]]:
+        """Свой запрос из локального индекса; None — если индекс не покрывает
+        запрос и нужен живой поиск"""
+        if self.covering_brand(text, days_back) is None:
+            return None
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        return await self.db.search_titles(text, cutoff_date)
+
+    async def get_recent(self, days_back: int) -> List[Ad]:
+        """Объявления всех брендов за период с подписью бренда"""
+        cutoff_date = datetime.now() - timedelta(days=days_back)
+        all_results = AdCollection()
+        # В базе у каждого объявления уже есть бренд
+        all_results.extend(await self.db.get_recent_ads(cutoff_date))
+        return all_results.to_list()
+
+
+class AdHarvester:
+    """Фоновая задача, которая по расписанию собирает объявления всех брендов.
+
+    Бренды обходятся по очереди с равными паузами, поэтому нагрузка на Kufar
+    постоянна и не зависит от числа пользователей.
+    """
+
+    def __init__(self,
+                 store: AdStore,
+                 interval: float = HARVEST_INTERVAL,
+                 days_back: int = HARVEST_DAYS_BACK):
+        self.store = store
+        self.interval = interval
+        self.days_back = days_back
+        self._task: Optional[asyncio.Task] = None
+
+    async def harvest_query(self, api: KufarAPI, brand: str,
+                            search_query: str) -> Tuple[int, datetime]:
+        """Догружает объявления запроса новее его водяного знака; возвращает
+        число сохраненных и начало непрерывного покрытия запроса.
+
+        Как у FirehoseHarvester, второй знак (<запрос>:since) хранит начало
+        покрытия. Если обход уперся в KUFAR_MAX_PAGES и не дошел до прошлого
+        знака, между ними остается дыра, и покрытие начинается заново с
+        последней полученной страницы.
+        """
+        db = self.store.db
+        coverage_key = f"{search_query}:since"
+        horizon = datetime.now() - timedelta(days=self.days_back)
+        watermark = await db.get_watermark(search_query)
+        covered_since = await db.get_watermark(coverage_key)
+        if (watermark is not None and covered_since is not None
+                and ts_to_datetime(watermark) > horizon):
+            since = ts_to_datetime(watermark)
+        else:
+            # Первый проход, старый знак без начала покрытия или знак
+            # старше горизонта — собираем за весь период
+            covered_since = None
+            since = horizon
+
+        ads, reached = await api.fetch_since(search_query, since)
+        written = await self.store.upsert(brand, ads) if ads else 0
+
+        if reached > since:
+            logger.warning(
+                f"⚠️ Запрос '{search_query}' не догружен за "
+                f"{KUFAR_MAX_PAGES} стр., покрытие начинается заново")
+            covered_since = datetime_to_ts(reached)
+        elif covered_since is None:
+            covered_since = datetime_to_ts(since)
+        await db.set_watermark(coverage_key, covered_since)
+        if ads:
+            await db.set_watermark(search_query, max(ad.ts for ad in ads))
+        return written, ts_to_datetime(
+            await db.get_watermark(coverage_key))
+
+    async def harvest_brand(self, api: KufarAPI, brand: str):
+        """Собирает все варианты бренда. Бренд считается собранным, только
+        если выдача каждого варианта пройдена до конца: иначе обработчики
+        продолжают искать вживую"""
+        results = await asyncio.gather(*(
+            self.harvest_query(api, brand, search_query)
+            for search_query in SEARCH_QUERIES[brand]),
+                                       return_exceptions=True)
+        errors = [
+            result for result in results if isinstance(result, BaseException)
+        ]
+        harvested = [
+            result for result in results
+            if not isinstance(result, BaseException)
+        ]
+        written = sum(count for count, _ in harvested)
+        logger.info(f"🌾 Сохранено {written} новых объявлений для '{brand}'")
+        if errors:
+            raise errors[0]
+        # Бренд покрыт с самой поздней из дат покрытия его вариантов
+        self.store.mark_synced(
+            brand, max(covered_since for _, covered_since in harvested))
+
+    async def run_once(self):
+        pause = self.interval / max(1, len(SEARCH_QUERIES))
+        async with KufarAPI() as api:
+            for brand in SEARCH_QUERIES:
+                try:
+                    await self.harvest_brand(api, brand)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    logger.error(f"❌ Ошибка сбора для '{brand}': {e}")
+                await asyncio.sleep(pause)
+
+    async def run(self):
+        while True:
+            await self.run_once()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+            logger.info("🌾 Фоновый сборщик объявлений запущен")
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+class FirehoseHarvester(AdHarvester):
+    """Сборщик в режиме firehose: раз в interval сек. проходит ленту новых
+    объявлений (по категориям FIREHOSE_CATEGORIES или целиком) и
+    раскладывает их по брендам локально через brand_matcher.
+
+    Каждая лента продолжает с водяного знака — list_time самого нового
+    увиденного объявления. Второй водяной знак хранит начало непрерывного
+    покрытия: если проход уперся в предел страниц и не дошел до прошлого
+    знака, в базе остается дыра, и покрытие начинается заново.
+    """
+
+    WATERMARK_KEY = "__firehose__"
+
+    def __init__(self,
+                 store: AdStore,
+                 interval: float = HARVEST_INTERVAL,
+                 days_back: int = HARVEST_DAYS_BACK,
+                 categories: Optional[List[str]] = None,
+                 backfill_days: int = FIREHOSE_BACKFILL_DAYS,
+                 max_pages: int = FIREHOSE_MAX_PAGES):
+        super().__init__(store, interval, days_back)
+        self.categories = list(
+            FIREHOSE_CATEGORIES if categories is None else categories)
+        self.backfill_days = backfill_days
+        self.max_pages = max_pages
+
+    def _watermark_key(self, category: Optional[str]) -> str:
+        if category is None:
+            return self.WATERMARK_KEY
+        return f"{self.WATERMARK_KEY}:{category}"
+
+    async def harvest_stream(self, api: KufarAPI,
+                             category: Optional[str]) -> Optional[datetime]:
+        """Догружает одну ленту; возвращает начало ее непрерывного покрытия
+        (None — лента недоступна)"""
+        db = self.store.db
+        key = self._watermark_key(category)
+        horizon = datetime.now() - timedelta(days=self.days_back)
+        watermark = await db.get_watermark(key)
+        if watermark is not None and ts_to_datetime(watermark) > horizon:
+            since = ts_to_datetime(watermark)
+        else:
+            watermark = None
+            since = datetime.now() - timedelta(days=self.backfill_days)
+
+        newest_ts = 0
+        oldest_date = None
+        pages = written = matched = 0
+        async for ads, page_oldest in api.iter_newest_pages(
+                since, category, self.max_pages):
+            pages += 1
+            if page_oldest is not None:
+                oldest_date = page_oldest
+            if ads:
+                matched += len(ads)
+                written += await self.store.upsert(None, ads)
+                newest_ts = max(newest_ts, max(ad.ts for ad in ads))
+            if pages == 1 and page_oldest is not None:
+                # Знак двигается, даже если на первых страницах нет брендов:
+                # самая старая дата первой страницы не новее ни одного
+                # объявления ленты, так что следующий проход ничего не пропустит
+                newest_ts = max(newest_ts, datetime_to_ts(page_oldest))
+
+        if oldest_date is None:
+            return None
+
+        coverage_key = f"{key}:since"
+        if oldest_date < since:
+            # Дошли до прошлого знака: покрытие продолжается
+            covered_since = await db.get_watermark(coverage_key)
+            if watermark is None or covered_since is None:
+                covered_since = datetime_to_ts(since)
+        else:
+            logger.warning(
+                f"⚠️ Лента '{category or 'все'}' не догружена за "
+                f"{self.max_pages} стр., покрытие начинается заново")
+            covered_since = datetime_to_ts(oldest_date)
+        await db.set_watermark(coverage_key, covered_since)
+        if newest_ts:
+            await db.set_watermark(key, newest_ts)
+
+        logger.info(f"🌊 Лента '{category or 'все'}': {pages} стр., "
+                    f"{matched} объявлений брендов, сохранено {written}")
+        return ts_to_datetime(await db.get_watermark(coverage_key))
+
+    async def run_once(self):
+        started = time.monotonic()
+        try:
+            async with KufarAPI() as api:
+                coverage = await asyncio.gather(*(
+                    self.harvest_stream(api, category)
+                    for category in (self.categories or [None])))
+            if all(covered_since is not None for covered_since in coverage):
+                # Все бренды покрыты с самой поздней из дат покрытия лент
+                covered_since = max(coverage)
+                for brand in SEARCH_QUERIES:
+                    self.store.mark_synced(brand, covered_since)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Ошибка сбора ленты: {e}")
+        await asyncio.sleep(
+            max(0.0, self.interval - (time.monotonic() - started)))
+
+
+class MirrorProber:
+    """Фоновая легкая проба всех зеркал (size=1), чтобы статистика
+    резервных зеркал не устаревала, пока трафик идет на основное"""
+
+    PROBE_PARAMS = {"query": "hikikomori", "size": 1, "lang": "ru"}
+
+    def __init__(self, interval: float = MIRROR_PROBE_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def probe_once(self):
+        async with KufarAPI() as api:
+            await asyncio.gather(*(api._request(url, self.PROBE_PARAMS)
+                                   for url in kufar_mirror_urls()
+                                   if get_mirror(url).breaker.allow_request()))
+        logger.info("🩺 Рейтинг зеркал: " + ", ".join(
+            f"{stats['url']} ({stats['state']}, {stats['score']:.2f} сек.)"
+            for stats in mirror_stats()))
+
+    async def run(self):
+        while True:
+            try:
+                await self.probe_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"❌ Ошибка пробы зеркал: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+
+
+ad_store = AdStore(db)
+harvester = (FirehoseHarvester(ad_store) if HARVEST_MODE == "firehose"
+             else AdHarvester(ad_store))
+mirror_prober = MirrorProber()
 
 
 def format_price(price: float, currency: str = "BYN") -> str:
@@ -1308,34 +3805,34 @@ async def delete_previous_messages(chat_id: int,
         logger.error(f"❌ Ошибка при очистке: {e}")
 
 
-def format_ad_text(ad: Dict[str, Any],
+def format_ad_text(ad: Ad,
                    index: int,
                    show_source: bool = False,
                    currency: str = "BYN") -> str:
     """Форматирует текст объявления"""
     date_str = ""
-    if "date" in ad:
-        msk_date = ad["date"] + timedelta(hours=3)
+    if ad.ts:
+        msk_date = ad.date + timedelta(hours=3)
         date_str = f"📅 {msk_date.strftime('%d.%m.%Y %H:%M')} МСК\n"
 
     source_str = ""
-    if show_source and "search_query_display" in ad:
-        source_str = f"🏷️ <b>Бренд:</b> {ad['search_query_display']}\n"
+    if show_source and ad.brand:
+        source_str = f"🏷️ <b>Бренд:</b> {ad.brand_display}\n"
 
-    price_text = format_price(ad['price'], currency)
+    price_text = format_price(ad.price, currency)
 
-    ad_text = (f"<b>{index}. {ad['title']}</b>\n"
+    ad_text = (f"<b>{index}. {ad.title}</b>\n"
                f"{source_str}"
                f"{date_str}"
                f"{price_text}\n"
-               f"🔗 <a href='{ad['link']}'>Ссылка на объявление</a>\n\n")
+               f"🔗 <a href='{ad.link}'>Ссылка на объявление</a>\n\n")
 
     return ad_text
 
 
 async def update_message_with_results(message: types.Message,
                                       state: FSMContext,
-                                      ads: List[Dict[str, Any]],
+                                      ads: List[Ad],
                                       title: str,
                                       show_source: bool = False,
                                       page: int = 1,
@@ -1344,7 +3841,7 @@ async def update_message_with_results(message: types.Message,
     """Обновляет сообщение с результатами поиска"""
 
     user_id = message.chat.id
-    settings = db.get_user_settings(user_id)
+    settings = await db.get_user_settings(user_id)
     lang = settings["language"]
 
     if not ads:
@@ -1408,6 +3905,35 @@ async def update_message_with_results(message: types.Message,
                             disable_web_page_preview=True)
 
 
+async def show_first_page(message: types.Message,
+                          ads: List[Ad],
+                          title: str,
+                          lang: str,
+                          currency: str = "BYN",
+                          days_back: int = 10):
+    """Показывает первую страницу результатов, пока догружаются остальные
+    (без кнопок: число страниц еще неизвестно)"""
+    if days_back == 1:
+        period_text = TRANSLATIONS[lang]["last_24h"]
+    else:
+        period_text = TRANSLATIONS[lang]["last_days"].format(days=days_back)
+
+    full_text = (
+        f"{TRANSLATIONS[lang]['search_results'].format(title=title)}\n"
+        f"{period_text}\n"
+        f"{'═' * 30}\n\n")
+    for i, ad in enumerate(ads, start=1):
+        full_text += format_ad_text(ad, i, False, currency)
+    full_text += f"{'═' * 30}\n⏳ <i>{TRANSLATIONS[lang]['loading_results']}...</i>"
+
+    try:
+        await message.edit_text(full_text,
+                                parse_mode=ParseMode.HTML,
+                                disable_web_page_preview=True)
+    except Exception:
+        pass
+
+
 @dp.callback_query_handler(pagination_cb.filter(),
                            state=PaginationStates.browsing_results)
 async def process_pagination(callback_query: CallbackQuery,
@@ -1440,10 +3966,15 @@ async def process_pagination(callback_query: CallbackQuery,
 
 
 async def calculate_brand_statistics(search_queries: List[str],
-                                     currency: str = "BYN") -> Dict[str, Any]:
+                                     currency: str = "BYN",
+                                     query_key: Optional[str] = None
+                                     ) -> Dict[str, Any]:
     """Рассчитывает статистику по бренду"""
-    async with KufarAPI() as api:
-        ads = await api.search_ads(search_queries, days_back=30)
+    if query_key and ad_store.is_fresh(query_key, 30):
+        ads = await ad_store.get_brand_ads(query_key, 30)
+    else:
+        async with KufarAPI() as api:
+            ads = await api.search_ads(search_queries, days_back=30)
 
     if not ads:
         return {
@@ -1454,10 +3985,10 @@ async def calculate_brand_statistics(search_queries: List[str],
             "min_price": 0
         }
 
-    week_ago = datetime.now() - timedelta(days=7)
-    week_ads = [ad for ad in ads if ad.get("date", datetime.min) >= week_ago]
+    week_ago = datetime_to_ts(datetime.now() - timedelta(days=7))
+    week_ads = [ad for ad in ads if ad.ts >= week_ago]
 
-    prices = [ad["price"] for ad in ads if ad["price"] > 0]
+    prices = [ad.price for ad in ads if ad.price > 0]
 
     # Конвертируем цены для статистики (BYN -> выбранная валюта)
     if currency != "BYN":
@@ -1476,10 +4007,9 @@ async def calculate_brand_statistics(search_queries: List[str],
 
 
 @dp.callback_query_handler(settings_cb.filter(action="main"))
-async def settings_main(callback_query: CallbackQuery, state: FSMContext):
+async def settings_main(callback_query: CallbackQuery, state: FSMContext,
+                        settings: Dict[str, Any]):
     """Главное меню настроек"""
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     await state.finish()
@@ -1495,10 +4025,9 @@ async def settings_main(callback_query: CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query_handler(settings_cb.filter(action="depth"))
-async def settings_depth(callback_query: CallbackQuery, state: FSMContext):
+async def settings_depth(callback_query: CallbackQuery, state: FSMContext,
+                         settings: Dict[str, Any]):
     """Настройка глубины поиска"""
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     await callback_query.answer()
@@ -1516,10 +4045,9 @@ async def settings_depth(callback_query: CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query_handler(settings_cb.filter(action="currency"))
-async def settings_currency(callback_query: CallbackQuery, state: FSMContext):
+async def settings_currency(callback_query: CallbackQuery, state: FSMContext,
+                            settings: Dict[str, Any]):
     """Настройка валюты"""
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     await callback_query.answer()
@@ -1537,10 +4065,9 @@ async def settings_currency(callback_query: CallbackQuery, state: FSMContext):
 
 
 @dp.callback_query_handler(settings_cb.filter(action="language"))
-async def settings_language(callback_query: CallbackQuery, state: FSMContext):
+async def settings_language(callback_query: CallbackQuery, state: FSMContext,
+                            settings: Dict[str, Any]):
     """Настройка языка"""
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     await callback_query.answer()
@@ -1559,22 +4086,22 @@ async def settings_language(callback_query: CallbackQuery, state: FSMContext):
 
 @dp.callback_query_handler(depth_cb.filter())
 async def process_depth_selection(callback_query: CallbackQuery,
-                                  callback_data: dict, state: FSMContext):
+                                  callback_data: dict, state: FSMContext,
+                                  settings: Dict[str, Any]):
     """Обработка выбора глубины поиска"""
     user_id = callback_query.from_user.id
     value = callback_data["value"]
 
     if value == "custom":
-        lang = db.get_user_settings(user_id)["language"]
+        lang = settings["language"]
         await callback_query.message.edit_text(
             TRANSLATIONS[lang]["enter_custom_days"], parse_mode=ParseMode.HTML)
         await SearchStates.waiting_for_custom_days.set()
         return
 
     days = int(value)
-    db.update_days_back(user_id, days)
+    await db.update_days_back(user_id, days)
 
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     # Остаемся в том же меню
@@ -1591,7 +4118,8 @@ async def process_depth_selection(callback_query: CallbackQuery,
 
 
 @dp.message_handler(state=SearchStates.waiting_for_custom_days)
-async def process_custom_days(message: types.Message, state: FSMContext):
+async def process_custom_days(message: types.Message, state: FSMContext,
+                              settings: Dict[str, Any]):
     """Обработка пользовательского значения дней"""
     user_id = message.from_user.id
 
@@ -1600,14 +4128,13 @@ async def process_custom_days(message: types.Message, state: FSMContext):
         if days < 1 or days > 365:
             raise ValueError
     except ValueError:
-        lang = db.get_user_settings(user_id)["language"]
+        lang = settings["language"]
         await message.answer(TRANSLATIONS[lang]["invalid_days"])
         return
 
-    db.update_days_back(user_id, days)
+    await db.update_days_back(user_id, days)
     await state.finish()
 
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     # Возвращаемся в меню настроек
@@ -1629,9 +4156,9 @@ async def process_currency_selection(callback_query: CallbackQuery,
     user_id = callback_query.from_user.id
     currency = callback_data["value"]
 
-    db.update_currency(user_id, currency)
+    await db.update_currency(user_id, currency)
 
-    settings = db.get_user_settings(user_id)
+    settings = await db.get_user_settings(user_id)
     lang = settings["language"]
 
     # Остаемся в том же меню
@@ -1654,9 +4181,9 @@ async def process_language_selection(callback_query: CallbackQuery,
     user_id = callback_query.from_user.id
     new_lang = callback_data["value"]
 
-    db.update_language(user_id, new_lang)
+    await db.update_language(user_id, new_lang)
 
-    settings = db.get_user_settings(user_id)
+    settings = await db.get_user_settings(user_id)
     lang = settings["language"]
 
     # Остаемся в том же меню с новым языком
@@ -1724,10 +4251,8 @@ async def show_parallel_animation(message: types.Message, button_name: str,
 
 
 @dp.message_handler(commands=["start"])
-async def cmd_start(message: types.Message):
+async def cmd_start(message: types.Message, settings: Dict[str, Any]):
     """Главное меню при старте (убрано декоративное сообщение)"""
-    user_id = message.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     welcome_text = (f"✨ <b>{TRANSLATIONS[lang]['welcome']}</b> ✨\n\n"
@@ -1746,10 +4271,8 @@ async def cmd_start(message: types.Message):
 
 
 @dp.message_handler(commands=["menu"])
-async def cmd_menu(message: types.Message):
+async def cmd_menu(message: types.Message, settings: Dict[str, Any]):
     """Показывает главное меню"""
-    user_id = message.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     main_msg = await message.answer(TRANSLATIONS[lang]["choose_action"],
@@ -1762,11 +4285,10 @@ async def cmd_menu(message: types.Message):
 
 @dp.callback_query_handler(text="back_to_menu", state="*")
 async def process_back_to_menu(callback_query: CallbackQuery,
-                               state: FSMContext):
+                               state: FSMContext,
+                               settings: Dict[str, Any]):
     """Возвращает пользователя в главное меню"""
     await state.finish()
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     welcome_text = (f"✨ <b>{TRANSLATIONS[lang]['welcome']}</b> ✨\n\n"
@@ -1784,13 +4306,13 @@ async def process_back_to_menu(callback_query: CallbackQuery,
 
 @dp.callback_query_handler(search_cb.filter())
 async def process_search_callback(callback_query: CallbackQuery,
-                                  callback_data: dict, state: FSMContext):
+                                  callback_data: dict, state: FSMContext,
+                                  settings: Dict[str, Any]):
     query_key = callback_data["query_key"]
     search_queries = SEARCH_QUERIES.get(query_key, [query_key])
     button_name = BUTTON_NAMES.get(query_key, query_key)
 
     user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
     currency = settings["currency"]
     days_back = settings["days_back"]
@@ -1803,19 +4325,22 @@ async def process_search_callback(callback_query: CallbackQuery,
         parse_mode=ParseMode.HTML)
 
     try:
-        api = KufarAPI()
-        await api.__aenter__()
-        search_task = asyncio.create_task(
-            api.search_ads(search_queries, days_back))
+        if ad_store.is_fresh(query_key, days_back):
+            # Бренд уже собран фоновым сборщиком — отвечаем из хранилища
+            ads = await ad_store.get_brand_ads(query_key, days_back)
+        else:
+            async with KufarAPI() as api:
+                search_task = asyncio.create_task(
+                    api.search_ads(search_queries, days_back))
 
-        # Передаем days_back в анимацию
-        await show_parallel_animation(callback_query.message, button_name,
-                                      search_task, lang, days_back)
+                # Передаем days_back в анимацию
+                await show_parallel_animation(callback_query.message,
+                                              button_name, search_task, lang,
+                                              days_back)
 
-        ads = await search_task
-        await api.__aexit__(None, None, None)
+                ads = await search_task
 
-        db.save_search_history(user_id, button_name, len(ads))
+        history_writer.add(user_id, button_name, len(ads), "brand")
 
         await update_message_with_results(callback_query.message,
                                           state,
@@ -1838,9 +4363,8 @@ async def process_search_callback(callback_query: CallbackQuery,
 
 @dp.callback_query_handler(recent_cb.filter(action="show"))
 async def process_recent_callback(callback_query: CallbackQuery,
-                                  state: FSMContext):
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
+                                  state: FSMContext,
+                                  settings: Dict[str, Any]):
     lang = settings["language"]
     currency = settings["currency"]
 
@@ -1852,17 +4376,18 @@ async def process_recent_callback(callback_query: CallbackQuery,
         parse_mode=ParseMode.HTML)
 
     try:
-        api = KufarAPI()
-        await api.__aenter__()
-        search_task = asyncio.create_task(api.search_all_ads_recent())
+        if ad_store.is_fresh_all(LAST_24H_HOURS):
+            ads = await ad_store.get_recent(LAST_24H_HOURS)
+        else:
+            async with KufarAPI() as api:
+                search_task = asyncio.create_task(api.search_all_ads_recent())
 
-        # Передаем days_back=1 в анимацию
-        await show_parallel_animation(callback_query.message,
-                                      TRANSLATIONS[lang]["recent"],
-                                      search_task, lang, 1)
+                # Передаем days_back=1 в анимацию
+                await show_parallel_animation(callback_query.message,
+                                              TRANSLATIONS[lang]["recent"],
+                                              search_task, lang, 1)
 
-        ads = await search_task
-        await api.__aexit__(None, None, None)
+                ads = await search_task
 
         await update_message_with_results(callback_query.message,
                                           state,
@@ -1886,10 +4411,9 @@ async def process_recent_callback(callback_query: CallbackQuery,
 
 @dp.callback_query_handler(custom_search_cb.filter(action="start"))
 async def process_custom_search_start(callback_query: CallbackQuery,
-                                      state: FSMContext):
+                                      state: FSMContext,
+                                      settings: Dict[str, Any]):
     """Начало кастомного поиска"""
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     await callback_query.answer()
@@ -1911,10 +4435,10 @@ async def process_custom_search_start(callback_query: CallbackQuery,
 @dp.message_handler(state=SearchStates.waiting_for_query,
                     content_types=types.ContentTypes.TEXT)
 async def process_custom_search_query(message: types.Message,
-                                      state: FSMContext):
+                                      state: FSMContext,
+                                      settings: Dict[str, Any]):
     """Обработка введенного запроса"""
     user_id = message.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
     currency = settings["currency"]
     days_back = settings["days_back"]
@@ -1958,21 +4482,39 @@ async def process_custom_search_query(message: types.Message,
         logger.info("✅ Отправлено новое сообщение")
 
     try:
-        api = KufarAPI()
-        await api.__aenter__()
-        search_task = asyncio.create_task(
-            api.search_ads([search_query], days_back))
-
-        # Передаем days_back в анимацию
-        await show_parallel_animation(original_message, f"'{search_query}'",
-                                      search_task, lang, days_back)
-
-        ads = await search_task
-        await api.__aexit__(None, None, None)
+        # Сначала пробуем локальный полнотекстовый индекс
+        ads = await ad_store.search_custom(search_query, days_back)
+        if ads is None:
+            async with KufarAPI() as api:
+                # Анимация идет до первой готовой страницы или до конца поиска
+                first_page = asyncio.get_running_loop().create_future()
+
+                def on_first_page(page_ads: Optional[List[Ad]]):
+                    if not first_page.done():
+                        first_page.set_result(page_ads)
+
+                search_task = asyncio.create_task(
+                    api.search_ads([search_query],
+                                   days_back,
+                                   on_first_page=on_first_page))
+                search_task.add_done_callback(
+                    lambda _: on_first_page(None))
+
+                # Передаем days_back в анимацию
+                await show_parallel_animation(original_message,
+                                              f"'{search_query}'",
+                                              first_page, lang, days_back)
+                if not search_task.done() and first_page.result():
+                    await show_first_page(original_message,
+                                          first_page.result(),
+                                          search_query, lang, currency,
+                                          days_back)
+
+                ads = await search_task
 
         logger.info(f"📊 Найдено {len(ads)} объявлений")
 
-        db.save_search_history(user_id, search_query, len(ads))
+        history_writer.add(user_id, search_query, len(ads), "custom")
 
         await update_message_with_results(original_message,
                                           state,
@@ -1993,11 +4535,10 @@ async def process_custom_search_query(message: types.Message,
 
 @dp.callback_query_handler(stats_cb.filter())
 async def process_stats_callback(callback_query: CallbackQuery,
-                                 callback_data: dict):
+                                 callback_data: dict,
+                                 settings: Dict[str, Any]):
     """Обработчик статистики"""
     query_key = callback_data["query_key"]
-    user_id = callback_query.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
     currency = settings["currency"]
 
@@ -2021,7 +4562,8 @@ async def process_stats_callback(callback_query: CallbackQuery,
         parse_mode=ParseMode.HTML)
 
     try:
-        stats = await calculate_brand_statistics(search_queries, currency)
+        stats = await calculate_brand_statistics(search_queries, currency,
+                                                 query_key)
 
         if stats["total"] == 0:
             stats_text = (
@@ -2070,10 +4612,8 @@ async def debug_all_callbacks(callback_query: CallbackQuery):
 
 
 @dp.message_handler()
-async def handle_unknown(message: types.Message):
+async def handle_unknown(message: types.Message, settings: Dict[str, Any]):
     """Обработчик неизвестных команд"""
-    user_id = message.from_user.id
-    settings = db.get_user_settings(user_id)
     lang = settings["language"]
 
     sent_message = await message.answer(
@@ -2083,6 +4623,39 @@ async def handle_unknown(message: types.Message):
     await delete_previous_messages(message.chat.id, sent_message.message_id)
 
 
+async def on_startup(dispatcher: Dispatcher):
+    """Запуск бота: открываем общую сессию для Kufar"""
+    global kufar_session
+    kufar_session = create_kufar_session()
+    logger.info("🌐 Общая сессия Kufar API открыта")
+    mirror_prober.start()
+    history_writer.start()
+    # Polling начинается после on_startup: перевод базы не задерживает
+    # обработчики, а только запуск
+    await retention_job.prepare()
+    retention_job.start()
+    if HARVESTER_ENABLED:
+        harvester.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    """Остановка бота: останавливаем сборщик, закрываем общую сессию,
+    дописываем историю поиска и закрываем соединения с базой"""
+    global kufar_session
+    await harvester.stop()
+    await mirror_prober.stop()
+    if kufar_session and not kufar_session.closed:
+        await kufar_session.close()
+    kufar_session = None
+    logger.info("🌐 Общая сессия Kufar API закрыта")
+    if kufar_cassette is not None:
+        kufar_cassette.close()
+    await retention_job.stop()
+    await history_writer.stop()
+    db.close()
+    logger.info("💾 Соединения с базой закрыты")
+
+
 if __name__ == "__main__":
     print("=" * 70)
     print("🚀 KUFAR SEARCH BOT С НАСТРОЙКАМИ (ФИНАЛЬНАЯ ВЕРСИЯ)")
@@ -2098,4 +4671,7 @@ if __name__ == "__main__":
     print("⚡ Улучшенная анимация с переводом")
     print(f"📚 {len(KUFAR_FACTS)} фактов о Kufar")
     print("=" * 70)
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(dp,
+                           skip_updates=True,
+                           on_startup=on_startup,
+                           on_shutdown=on_shutdown)